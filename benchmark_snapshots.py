@@ -0,0 +1,98 @@
+import copyreg
+import io
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "src"))
+
+from agent import Player  # noqa: E402
+from agent.memory import Memory  # noqa: E402
+from game import Process  # noqa: E402
+from sampler.sampler import stream_archive  # noqa: E402
+from sampler.snapshot import (  # noqa: E402
+    create_snapshot_store,
+    dump_game,
+    load_game,
+)
+from utils.utils import read_json  # noqa: E402
+
+
+class LegacyPickler(pickle.Pickler):
+    """
+    Pickles games as before the compact format,
+    with the full state of every process, player and memory.
+    """
+
+    def reducer_override(self, obj):
+        if isinstance(obj, (Process, Player, Memory)):
+            return copyreg.__newobj__, (type(obj),), obj.__dict__.copy()
+        return NotImplemented
+
+
+def dump_legacy(game) -> bytes:
+    f = io.BytesIO()
+    LegacyPickler(f, protocol=4).dump(game)
+    return f.getvalue()
+
+
+FORMATS = {
+    "legacy": dump_legacy,
+    "compact": lambda game: dump_game(game),
+    "compact+zlib": lambda game: dump_game(game, "zlib"),
+    "compact+lzma": lambda game: dump_game(game, "lzma"),
+}
+
+
+def benchmark(path: str, repeat: int = 5):
+    """
+    Compare the size and load time of the snapshots of a sampling run
+    as stored, and in the legacy and the compact formats.
+    Games recorded before the compact format still hold what it leaves out
+    while playing, e.g. the memory of the moderator,
+    so the snapshots of a run recorded since then are smaller as stored
+    than in the legacy format.
+    """
+    config = read_json(os.path.join(path, "config.json"))
+    snapshots = create_snapshot_store(
+        os.path.join(path, ".game"), config.get("snapshot_store", "pickle"))
+    stored = [
+        snapshots.read(node_id) for node_id, _, _ in stream_archive(path)
+        if snapshots.exists(node_id)
+    ]
+    snapshots.close()
+    games = [load_game(data) for data in stored]
+    print(f"{path}: {len(games)} snapshots")
+
+    baseline = None
+    for name, dump in FORMATS.items():
+        start = time.perf_counter()
+        data = [dump(game) for game in games]
+        dump_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for x in data:
+                load_game(x)
+        load_seconds = (time.perf_counter() - start) / repeat
+        size = sum(len(x) for x in data)
+        if baseline is None:
+            baseline = size, load_seconds
+        print(
+            f"  {name:<14} {size / len(data) / 1024:8.1f} KB/snapshot"
+            f"  {size / baseline[0]:6.1%} size"
+            f"  {dump_seconds / len(data) * 1e3:7.3f} ms dump"
+            f"  {load_seconds / len(data) * 1e3:7.3f} ms load"
+            f"  {load_seconds / baseline[1]:6.1%} load time"
+        )
+    size = sum(len(x) for x in stored)
+    print(
+        f"  {'as stored':<14} {size / len(stored) / 1024:8.1f} KB/snapshot"
+        f"  {size / baseline[0]:6.1%} size"
+    )
+
+
+if __name__ == '__main__':
+    # usage: python benchmark_snapshots.py data/狼人杀/<sample_id> ...
+    for path in sys.argv[1:]:
+        benchmark(path)
@@ -0,0 +1,103 @@
+import asyncio
+import atexit
+import os
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+
+class ClientLoop:
+    """
+    Runs the calls of an API backend on an event loop of its own,
+    on a daemon thread, with a long-lived client created on that loop,
+    so its pooled connections are kept alive between calls.
+    Calls may come from any thread or event loop,
+    e.g. the threads of concurrent subprocesses,
+    each playing its steps on a long-lived loop of the thread,
+    or the loop of async rollouts.
+    The loop and the client are started on first use,
+    again in a forked process, which can not use those of its parent.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            create_client: Callable[[], Awaitable[Any]],
+            close_client: Callable[[Any], Awaitable[None]]
+    ):
+        self.name = name
+        self.create_client = create_client
+        self.close_client = close_client
+        self.lock = threading.Lock()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self.client = None
+        self.inherited = None
+        self.pid = None
+        atexit.register(self.close)
+
+    def start(self) -> Tuple[asyncio.AbstractEventLoop, Any]:
+        """
+        Returns the running loop and its client, starting them if needed.
+        """
+        with self.lock:
+            if self.loop is None or self.pid != os.getpid():
+                # the client of a parent process can not be closed here,
+                # and is kept from being collected unclosed
+                self.inherited = self.client
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(
+                    target=loop.run_forever, name=self.name, daemon=True)
+                thread.start()
+                # the client is bound to the loop it is created on
+                self.client = asyncio.run_coroutine_threadsafe(
+                    self.create_client(), loop).result()
+                self.loop, self.thread, self.pid = loop, thread, os.getpid()
+            return self.loop, self.client
+
+    def submit(self, call: Callable[[Any], Awaitable]) -> Future:
+        """
+        Schedule a call with the client on the loop, from any thread.
+        """
+        loop, client = self.start()
+        return asyncio.run_coroutine_threadsafe(call(client), loop)
+
+    async def run(self, call: Callable[[Any], Awaitable]):
+        """
+        Await a call with the client from any event loop.
+        """
+        return await asyncio.wrap_future(self.submit(call))
+
+    def run_sync(self, call: Callable[[Any], Awaitable]):
+        """
+        Wait for a call with the client from synchronous code.
+        """
+        return self.submit(call).result()
+
+    def close(self):
+        """
+        Close the client and stop the loop, e.g. to change the settings
+        of the client, which is created again on next use.
+        Calls in flight are cancelled.
+        """
+        with self.lock:
+            loop, thread, client = self.loop, self.thread, self.client
+            owned = self.pid == os.getpid()
+            self.loop = self.thread = self.client = self.pid = None
+        if loop is None or not owned:
+            return
+
+        async def shutdown():
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.close_client(client)
+
+        try:
+            asyncio.run_coroutine_threadsafe(
+                shutdown(), loop).result(timeout=10)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
@@ -1,33 +1,99 @@
-import asyncio
 import json
 import os
 from typing import (
     Dict,
     List,
+    Optional,
 )
 
 import aiohttp
 from loguru import logger
 
-from utils.exceptions import BrainMalfunction
+from utils.exceptions import BrainMalfunction, RateLimited
+from .client import ClientLoop
+from .limiter import RateLimiter, parse_retry_after
 
 
 url = "https://api.deepseek.com/chat/completions"
 api_key = os.environ.get("DEEPSEEK_API_KEY")
 MODEL = "deepseek-reasoner"
+USAGE_KEYS = ("prompt_tokens", "completion_tokens", "total_tokens")
 
+# connections kept open to the API, shared by all calls,
+# and the timeouts of a call in seconds, see configure
+POOL_SIZE = int(os.environ.get("DEEPSEEK_POOL_SIZE", 64))
+TIMEOUT = float(os.environ.get("DEEPSEEK_TIMEOUT", 600))
+CONNECT_TIMEOUT = float(os.environ.get("DEEPSEEK_CONNECT_TIMEOUT", 10))
+KEEPALIVE_TIMEOUT = float(os.environ.get("DEEPSEEK_KEEPALIVE_TIMEOUT", 60))
+# requests and tokens per minute allowed by the provider, unlimited if unset
+RPM = float(os.environ.get("DEEPSEEK_RPM", 0))
+TPM = float(os.environ.get("DEEPSEEK_TPM", 0))
 
-async def complete_async(params):
+
+async def create_session() -> aiohttp.ClientSession:
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
     }
-    async with aiohttp.ClientSession(headers=headers) as session:
+    return aiohttp.ClientSession(
+        headers=headers,
+        connector=aiohttp.TCPConnector(
+            limit=POOL_SIZE,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=KEEPALIVE_TIMEOUT,
+        ),
+        timeout=aiohttp.ClientTimeout(
+            total=TIMEOUT, sock_connect=CONNECT_TIMEOUT),
+    )
+
+
+client = ClientLoop(
+    "deepseek-client", create_session, lambda session: session.close())
+# admits the calls of all threads and event loops,
+# configured with limiter.configure, e.g. limiter.configure(rpm=500)
+limiter = RateLimiter(rpm=RPM, tpm=TPM, max_concurrency=POOL_SIZE)
+
+
+def configure(
+        pool_size: Optional[int] = None,
+        timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        keepalive_timeout: Optional[float] = None
+):
+    """
+    Change the settings of the session,
+    which is created again with them on the next call.
+    """
+    global POOL_SIZE, TIMEOUT, CONNECT_TIMEOUT, KEEPALIVE_TIMEOUT
+    client.close()
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+        limiter.configure(max_concurrency=pool_size)
+    if timeout is not None:
+        TIMEOUT = timeout
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT = connect_timeout
+    if keepalive_timeout is not None:
+        KEEPALIVE_TIMEOUT = keepalive_timeout
+
+
+async def complete_async(params):
+    async def post(session: aiohttp.ClientSession):
         async with session.post(url, json=params) as response:
+            if response.status == 429:
+                raise RateLimited(
+                    "DeepSeek API rate limit",
+                    parse_retry_after(response.headers.get("Retry-After")))
             return await response.text()
 
+    return await client.run(post)
+
 
 def generate(messages: List[Dict[str, str]]):
+    return client.run_sync(lambda _: generate_async(messages))
+
+
+async def generate_async(messages: List[Dict[str, str]]):
     try:
         params = {
             "model": MODEL,
@@ -39,16 +105,27 @@ def generate(messages: List[Dict[str, str]]):
         }
         logger.trace(f"params: {params}")
 
-        response_text = asyncio.run(complete_async(params))
-        data = json.loads(response_text)
-        message = data['choices'][0]['message']
+        chars = sum(len(message["content"]) for message in messages)
+        async with limiter.limit(chars) as call:
+            response_text = await complete_async(params)
+            data = json.loads(response_text)
+            message = data['choices'][0]['message']
+
+            reasoning_content = message.get('reasoning_content')
+            content = message.get('content')
 
-        reasoning_content = message.get('reasoning_content')
-        content = message.get('content')
+            output = f"<think>\n{reasoning_content}\n</think>\n{content}"
+            logger.trace("output: " + repr(output))
 
-        output = f"<think>\n{reasoning_content}\n</think>\n{content}"
-        logger.trace("output: " + repr(output))
-    except:
+            usage = {
+                k: data.get('usage', {}).get(k, 0)
+                for k in USAGE_KEYS
+            }
+            call.tokens = usage["total_tokens"]
+        usage["rate_limit_seconds"] = call.wait_seconds
+    except RateLimited:
+        raise
+    except Exception:
         raise BrainMalfunction("DeepSeek API error")
 
-    return reasoning_content, content, output
+    return reasoning_content, content, output, usage
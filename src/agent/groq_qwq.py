@@ -1,27 +1,103 @@
-import asyncio
 import os
 import re
 from typing import (
     Dict,
     List,
+    Optional,
 )
 
-from groq import AsyncGroq
+import httpx
+from groq import (
+    APITimeoutError,
+    AsyncGroq,
+    DefaultAsyncHttpxClient,
+    RateLimitError,
+)
 from loguru import logger
 
-from utils.exceptions import BrainMalfunction
+from utils.exceptions import BrainMalfunction, RateLimited
+from .client import ClientLoop
+from .limiter import RateLimiter, parse_retry_after
 
 
 api_key = os.environ.get("GROQ_API_KEY")
 MODEL = "qwen-qwq-32b"
+USAGE_KEYS = ("prompt_tokens", "completion_tokens", "total_tokens")
+
+# connections kept open to the API, shared by all calls,
+# and the timeouts of a call in seconds, see configure
+POOL_SIZE = int(os.environ.get("GROQ_POOL_SIZE", 64))
+TIMEOUT = float(os.environ.get("GROQ_TIMEOUT", 600))
+CONNECT_TIMEOUT = float(os.environ.get("GROQ_CONNECT_TIMEOUT", 10))
+KEEPALIVE_TIMEOUT = float(os.environ.get("GROQ_KEEPALIVE_TIMEOUT", 60))
+# requests and tokens per minute allowed by the provider, unlimited if unset
+RPM = float(os.environ.get("GROQ_RPM", 0))
+TPM = float(os.environ.get("GROQ_TPM", 0))
+
+
+async def create_client() -> AsyncGroq:
+    return AsyncGroq(
+        api_key=api_key,
+        # 429 responses are left to the rate limiter
+        max_retries=0,
+        timeout=httpx.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT),
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=POOL_SIZE,
+                max_keepalive_connections=POOL_SIZE,
+                keepalive_expiry=KEEPALIVE_TIMEOUT,
+            )
+        ),
+    )
+
+
+client = ClientLoop(
+    "groq-client", create_client, lambda groq: groq.close())
+# admits the calls of all threads and event loops,
+# configured with limiter.configure, e.g. limiter.configure(rpm=500)
+limiter = RateLimiter(rpm=RPM, tpm=TPM, max_concurrency=POOL_SIZE)
+
+
+def configure(
+        pool_size: Optional[int] = None,
+        timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        keepalive_timeout: Optional[float] = None
+):
+    """
+    Change the settings of the client,
+    which is created again with them on the next call.
+    """
+    global POOL_SIZE, TIMEOUT, CONNECT_TIMEOUT, KEEPALIVE_TIMEOUT
+    client.close()
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+        limiter.configure(max_concurrency=pool_size)
+    if timeout is not None:
+        TIMEOUT = timeout
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT = connect_timeout
+    if keepalive_timeout is not None:
+        KEEPALIVE_TIMEOUT = keepalive_timeout
 
 
 async def complete_async(params):
-    client = AsyncGroq(api_key=api_key)
-    return await client.chat.completions.create(**params)
+    try:
+        return await client.run(
+            lambda groq: groq.chat.completions.create(**params))
+    except RateLimitError as e:
+        raise RateLimited(
+            "GROQ API rate limit",
+            parse_retry_after(e.response.headers.get("retry-after")))
+    except APITimeoutError as e:
+        raise TimeoutError("GROQ API timeout") from e
 
 
 def generate(messages: List[Dict[str, str]]):
+    return client.run_sync(lambda _: generate_async(messages))
+
+
+async def generate_async(messages: List[Dict[str, str]]):
     try:
         params = {
             "model": MODEL,
@@ -32,17 +108,28 @@ def generate(messages: List[Dict[str, str]]):
         }
         logger.trace(f"params: {params}")
 
-        response = asyncio.run(complete_async(params))
-        output = response.choices[0].message.content
+        chars = sum(len(message["content"]) for message in messages)
+        async with limiter.limit(chars) as call:
+            response = await complete_async(params)
+            output = response.choices[0].message.content
+
+            reasoning_content = re.findall(
+                r"(?<=<think>).*?(?=</think>)", output, re.DOTALL)[0].strip()
+            content = re.sub(r"<think>.*?</think>",
+                             "", output, flags=re.DOTALL).strip()
 
-        reasoning_content = re.findall(
-            r"(?<=<think>).*?(?=</think>)", output, re.DOTALL)[0].strip()
-        content = re.sub(r"<think>.*?</think>",
-                         "", output, flags=re.DOTALL).strip()
+            output = f"<think>\n{reasoning_content}\n</think>\n{content}"
+            logger.trace("output: " + repr(output))
 
-        output = f"<think>\n{reasoning_content}\n</think>\n{content}"
-        logger.trace("output: " + repr(output))
-    except:
+            usage = {
+                k: getattr(response.usage, k, 0) or 0
+                for k in USAGE_KEYS
+            }
+            call.tokens = usage["total_tokens"]
+        usage["rate_limit_seconds"] = call.wait_seconds
+    except RateLimited:
+        raise
+    except Exception:
         raise BrainMalfunction("GROQ API error")
 
-    return reasoning_content, content, output
+    return reasoning_content, content, output, usage
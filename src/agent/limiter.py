@@ -0,0 +1,295 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Optional
+
+from loguru import logger
+
+from utils.exceptions import RateLimited
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    The seconds of a Retry-After header, if given in seconds.
+    """
+    try:
+        return max(float(value), 0.)
+    except (TypeError, ValueError):
+        return None
+
+
+class Call:
+    """
+    A call admitted by the rate limiter.
+    The backend sets the tokens it used once they are known,
+    to correct the tokens reserved for it.
+    """
+
+    __slots__ = ("reserved", "tokens", "chars", "start", "wait_seconds")
+
+    def __init__(self, chars: int, reserved: int):
+        self.chars = chars
+        self.reserved = reserved
+        self.tokens: Optional[int] = None
+        self.start = 0.
+        self.wait_seconds = 0.
+
+
+class Waiter:
+    """
+    A call waiting for its turn, woken on the event loop it waits on.
+    """
+
+    __slots__ = ("loop", "future")
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def wake(self):
+        def set_result(future):
+            if not future.done():
+                future.set_result(None)
+
+        self.loop.call_soon_threadsafe(set_result, self.future)
+
+
+class RateLimiter:
+    """
+    Admits the LLM calls of a backend, from any thread or event loop,
+    in the order they come.
+    A call waits for a request of the requests-per-minute bucket,
+    its estimated tokens of the tokens-per-minute bucket,
+    and a free slot of the concurrency limit.
+    The concurrency limit follows AIMD:
+    it grows by about one per limit calls that succeed in time,
+    and is cut by the decrease factor on a 429 response,
+    a timeout, or a latency above the target latency, if set,
+    at most once for the calls in flight at the time of the cut.
+    After a 429 response, no call is admitted for the time
+    the provider asks, if it says, up to the max backoff.
+    Else, if the limit was cut before with no call succeeding since,
+    no call is admitted for a backoff doubling with every such cut.
+    A limit of None or 0 requests or tokens per minute is no limit.
+    """
+
+    def __init__(
+            self,
+            rpm: Optional[float] = None,
+            tpm: Optional[float] = None,
+            max_concurrency: int = 64,
+            min_concurrency: int = 1,
+            decrease: float = 0.5,
+            target_latency: Optional[float] = None,
+            backoff: float = 1.,
+            max_backoff: float = 60.
+    ):
+        self.lock = threading.Lock()
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # the buckets start full
+        self.requests = float(rpm or 0)
+        self.tokens = float(tpm or 0)
+        self.refilled = time.monotonic()
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.waiters: Deque[Waiter] = deque()
+        # calls started before the last cut do not cut the limit again
+        self.cut_at = 0.
+        self.blocked_until = 0.
+        self.throttled_in_a_row = 0
+        # learnt from the usage of calls, to estimate their tokens
+        self.tokens_per_char = 1.
+        # counts of calls
+        self.calls = 0
+        self.rate_limited = 0
+        self.timeouts = 0
+
+    def configure(self, **kwargs):
+        """
+        Change the limits, e.g. configure(rpm=500, tpm=0).
+        """
+        with self.lock:
+            for k, v in kwargs.items():
+                if not hasattr(self, k):
+                    raise AttributeError(f"RateLimiter has no setting {k}")
+                setattr(self, k, v)
+            self.concurrency = min(
+                max(self.concurrency, self.min_concurrency),
+                self.max_concurrency)
+            self.wake_next()
+
+    @property
+    def metrics(self) -> dict:
+        """
+        The current limits, and how much of them is in use.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            return {
+                "concurrency_limit": round(self.concurrency, 2),
+                "in_flight": self.in_flight,
+                "waiting": len(self.waiters),
+                "requests_available":
+                    int(self.requests) if self.rpm else None,
+                "tokens_available": int(self.tokens) if self.tpm else None,
+                "cooldown_seconds":
+                    round(max(0., self.blocked_until - now), 3),
+                "tokens_per_char": round(self.tokens_per_char, 3),
+                "calls": self.calls,
+                "rate_limited": self.rate_limited,
+                "timeouts": self.timeouts,
+            }
+
+    def refill(self, now: float):
+        elapsed = now - self.refilled
+        self.refilled = now
+        if self.rpm:
+            self.requests = min(
+                self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def admit(self, call: Call, now: float) -> Optional[float]:
+        """
+        Admit the call at the head of the queue if the limits allow it.
+        Returns None if admitted, or else the seconds to wait,
+        infinite if only a finished call frees a slot.
+        """
+        self.refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= max(int(self.concurrency), 1):
+            return math.inf
+        if self.rpm and self.requests < 1:
+            return (1 - self.requests) * 60 / self.rpm
+        # a call larger than the bucket waits for a full bucket
+        cost = min(call.reserved, self.tpm) if self.tpm else 0
+        if self.tpm and self.tokens < cost:
+            return (cost - self.tokens) * 60 / self.tpm
+        self.in_flight += 1
+        if self.rpm:
+            self.requests -= 1
+        if self.tpm:
+            self.tokens -= call.reserved
+        self.calls += 1
+        return None
+
+    def wake_next(self):
+        if self.waiters:
+            self.waiters[0].wake()
+
+    async def acquire(self, call: Call):
+        start = time.monotonic()
+        waiter = Waiter()
+        with self.lock:
+            self.waiters.append(waiter)
+        try:
+            while True:
+                with self.lock:
+                    if self.waiters[0] is waiter:
+                        delay = self.admit(call, time.monotonic())
+                    else:
+                        delay = math.inf
+                    if delay is None:
+                        self.waiters.popleft()
+                        # the next call may be admitted as well
+                        self.wake_next()
+                        break
+                    if waiter.future.done():
+                        waiter.future = waiter.loop.create_future()
+                await asyncio.wait(
+                    [waiter.future],
+                    timeout=None if delay == math.inf else delay)
+        except BaseException:
+            with self.lock:
+                if waiter in self.waiters:
+                    head = self.waiters[0] is waiter
+                    self.waiters.remove(waiter)
+                    if head:
+                        self.wake_next()
+            raise
+        call.start = time.monotonic()
+        call.wait_seconds = call.start - start
+
+    def cut(self, call: Call, now: float, reason: str) -> bool:
+        if call.start < self.cut_at:
+            return False
+        self.cut_at = now
+        self.concurrency = max(
+            self.concurrency * self.decrease, self.min_concurrency)
+        logger.warning(
+            f"{reason}, concurrency limit cut to {self.concurrency:.2f}")
+        return True
+
+    def release(
+            self,
+            call: Call,
+            error: Optional[BaseException] = None
+    ):
+        now = time.monotonic()
+        with self.lock:
+            self.in_flight -= 1
+            if self.tpm and call.tokens is not None:
+                # pay for the tokens used instead of those reserved
+                self.tokens -= call.tokens - call.reserved
+            if call.tokens and call.chars:
+                self.tokens_per_char += \
+                    0.1 * (call.tokens / call.chars - self.tokens_per_char)
+
+            if isinstance(error, RateLimited):
+                self.rate_limited += 1
+                retry_after = error.retry_after
+                if self.cut(call, now, "rate limited"):
+                    # cuts with no call succeeding in between
+                    self.throttled_in_a_row += 1
+                    if retry_after is None and self.throttled_in_a_row > 1:
+                        retry_after = min(
+                            self.backoff * 2 ** (self.throttled_in_a_row - 2),
+                            self.max_backoff)
+                if retry_after is not None:
+                    # e.g. a daily cap may ask for hours, the caller
+                    # gives up after some attempts instead of hanging
+                    self.blocked_until = max(
+                        self.blocked_until,
+                        now + min(retry_after, self.max_backoff))
+            elif isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+                self.timeouts += 1
+                self.cut(call, now, "LLM call timed out")
+            elif error is None:
+                self.throttled_in_a_row = 0
+                latency = now - call.start
+                if self.target_latency and latency > self.target_latency:
+                    self.cut(call, now, f"LLM call took {latency:.1f}s")
+                else:
+                    self.concurrency = min(
+                        self.concurrency + 1 / self.concurrency,
+                        self.max_concurrency)
+            self.wake_next()
+
+    @asynccontextmanager
+    async def limit(self, chars: int):
+        """
+        Wait for the turn of a call of about the given characters,
+        and release it once done.
+        Yields the call, for the backend to set the tokens it used.
+        """
+        call = Call(chars, math.ceil(chars * self.tokens_per_char))
+        await self.acquire(call)
+        try:
+            yield call
+        except BaseException as e:
+            self.release(call, e)
+            raise
+        self.release(call)
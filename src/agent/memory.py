@@ -1,9 +1,103 @@
+import sys
+from threading import Lock
+from typing import Iterator, Optional
+
+
+# players of a concurrent step speak to the same audience from their threads
+_append_lock = Lock()
+
+
+class MemoryLog:
+    """
+    An immutable log of memory records, shared between clones of a game.
+    Appending returns a new log which shares all the records before it,
+    so cloning a memory does not copy its history.
+    The records must not be modified once appended.
+    """
+
+    __slots__ = ("record", "prev", "length")
+
+    def __init__(
+            self,
+            record: Optional[dict] = None,
+            prev: Optional['MemoryLog'] = None
+    ):
+        self.record = record
+        self.prev = prev
+        self.length = prev.length + 1 if prev is not None else 0
+
+    @classmethod
+    def from_records(cls, records) -> 'MemoryLog':
+        log = cls()
+        for record in records:
+            log = log.append(record)
+        return log
+
+    def append(self, record: dict) -> 'MemoryLog':
+        return MemoryLog(record, self)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self) -> Iterator[dict]:
+        records = []
+        curr = self
+        while curr.prev is not None:
+            records.append(curr.record)
+            curr = curr.prev
+        return reversed(records)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        # a flat list, so long logs do not hit the recursion limit of pickle
+        return MemoryLog.from_records, (list(self),)
+
+
 class Memory:
     def __init__(self, agent):
         self.agent = agent
         self.language = agent.language
         self.consolidated = ""
-        self.cache = []
+        self.cache = MemoryLog()
+
+    def __getstate__(self):
+        """
+        The agent and its language are left out,
+        the agent binds the memory to itself once loaded.
+        """
+        state = self.__dict__.copy()
+        del state["agent"]
+        del state["language"]
+        return state
+
+    def __setstate__(self, state):
+        # snapshots taken before the log kept the cache as a list
+        if isinstance(state["cache"], list):
+            state["cache"] = MemoryLog.from_records(state["cache"])
+        self.__dict__.update(state)
+
+    def __copy__(self):
+        memory = Memory.__new__(Memory)
+        memory.__dict__.update(self.__dict__)
+        return memory
+
+    def fork(self, agent=None) -> 'Memory':
+        """
+        A copy of the memory sharing its log, optionally for another agent.
+        """
+        memory = self.__copy__()
+        if agent is not None:
+            memory.agent = agent
+        return memory
+
+    def append(self, record: dict):
+        with _append_lock:
+            self.cache = self.cache.append(record)
 
     def update_speech(self, content: str, speaker, audience: str):
         if self.language == "zh":
@@ -12,13 +106,15 @@ class Memory:
             you = "you"
         else:
             raise ValueError(f"Unsupported language: {self.language}")
-        audience = audience.replace(str(self.agent), you)
+        # the few distinct names are shared by the records of all players,
+        # so a snapshot stores each of them once
+        audience = sys.intern(audience.replace(str(self.agent), you))
         if speaker == self.agent:
             speaker = you
         else:
-            speaker = str(speaker)
+            speaker = sys.intern(str(speaker))
 
-        self.cache.append(
+        self.append(
             {
                 "type": "speech",
                 "speaker": speaker,
@@ -28,16 +124,28 @@ class Memory:
         )
 
     def update_thought(self, content: str):
-        self.cache.append(
+        self.append(
             {
                 "type": "thought",
                 "content": content,
             }
         )
 
+    def heard(self) -> dict:
+        """
+        What the agent has heard, leaving out its own thoughts.
+        """
+        return {
+            "consolidated": self.consolidated,
+            "speech": [
+                [record["speaker"], record["audience"], record["content"]]
+                for record in self.cache if record["type"] == "speech"
+            ],
+        }
+
     def consolidate(self, content: str):
         self.consolidated = content
-        self.cache = []
+        self.cache = MemoryLog()
 
     def retrieve(self):
         if self.language == "zh":
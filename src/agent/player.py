@@ -1,3 +1,4 @@
+import asyncio
 import os
 import random
 import time
@@ -11,19 +12,23 @@ from utils.utils import (
     one_line_str,
     write_jsonl_single_line,
     unique_identifier,
+    run_sync,
 )
 from utils.exceptions import (
     BadChoice,
     TooManyRetries,
     BrainMalfunction,
     InvalidToolCall,
+    RateLimited,
 )
 from .deepseek_reasoner import (
-    generate,
+    generate_async,
+    limiter,
     MODEL
 )
 # from .groq_qwq import (
-#     generate,
+#     generate_async,
+#     limiter,
 #     MODEL
 # )
 from .memory import Memory
@@ -35,6 +40,9 @@ from .tools import (
 
 
 class Player:
+    # whether the player keeps what it hears in its memory
+    remembers = True
+
     def __init__(
             self,
             game: Game,
@@ -50,6 +58,12 @@ class Player:
         self.tools = tools if tools is not None else []
         self.system = ""
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # the memory is pickled without its agent
+        self.memory.agent = self
+        self.memory.language = self.language
+
     def __str__(self):
         if self.language == "zh":
             return f"{self.id}号"
@@ -139,16 +153,37 @@ For each function call, return a json object with function name and arguments wi
         logger.info(f'{self} SPEAKS to {audience_str}: "{msg}"')
 
     def __hear(self, msg: str, speaker: 'Player', audience_str: str):
-        self.memory.update_speech(msg, speaker, audience_str)
+        if self.remembers:
+            self.memory.update_speech(msg, speaker, audience_str)
+
+    def trace_limits(self):
+        """
+        Record the current limits of the rate limiter in the trace.
+        """
+        tracer = self.game.tracer
+        if tracer.enabled:
+            metrics = limiter.metrics
+            for name in ("concurrency_limit", "in_flight", "waiting"):
+                tracer.counter(name, "llm", metrics[name])
 
     def generate_thought_and_content(
         self,
         prompt: str,
         tool: Optional[Tool] = None
     ):
+        return run_sync(self.generate_thought_and_content_async(prompt, tool))
+
+    async def generate_thought_and_content_async(
+        self,
+        prompt: str,
+        tool: Optional[Tool] = None
+    ):
 
         success = False
         attempts_remain = 10
+        # rate limited calls are paced by the rate limiter,
+        # so they get more attempts, each waiting up to its max backoff
+        rate_limited_remain = 30
         messages = [
             {"role": "system", "content": self.system},
             {"role": "user", "content": prompt}
@@ -157,6 +192,7 @@ For each function call, return a json object with function name and arguments wi
 
         while not success:
             try:
+                start = time.perf_counter()
                 #### dummy agent brain ####
                 # thought = f"test thought {unique_identifier()}"
                 # if isinstance(tool, SelectOnePlayer):
@@ -170,11 +206,24 @@ For each function call, return a json object with function name and arguments wi
                 # else:
                 #     content = f"test content {unique_identifier()}"
                 # output = f"<think>\n{thought}\n</think>\n{content}"
+                # usage = {}
                 #### dummy agent brain ####
 
                 #### real agent brain ####
-                thought, content, output = generate(messages)
+                with self.game.tracer.span(
+                        "generate", "llm", player=self.id) as span:
+                    if self.game.replay is not None:
+                        thought, content, output, usage = \
+                            self.game.replay.generate(
+                                self.game.curr.step_str, self.id, prompt)
+                    else:
+                        thought, content, output, usage = \
+                            await generate_async(messages)
+                        self.trace_limits()
+                    if span is not None:
+                        span.update(usage)
                 #### real agent brain ####
+                self.game.record_usage(usage, time.perf_counter() - start)
 
                 if tool is None:
                     result = content
@@ -192,18 +241,28 @@ For each function call, return a json object with function name and arguments wi
                     }
                 )
 
+            except RateLimited:
+                # the rate limiter holds the retry
+                # until the provider admits calls again
+                self.game.record_retry()
+                if not rate_limited_remain:
+                    raise TooManyRetries("Exceeded max rate limited attempts.")
+                logger.warning(f'{self} rate limited, retry')
+                rate_limited_remain -= 1
             except BrainMalfunction:
+                self.game.record_retry()
                 if not attempts_remain:
                     raise TooManyRetries("Exceeded max attempts.")
                 cooldown = 1
                 logger.warning(
                     f'{self} brain malfunction, retry after {cooldown}s')
-                time.sleep(cooldown)
+                await asyncio.sleep(cooldown)
                 attempts_remain -= 1
             except (
                 BadChoice,
                 InvalidToolCall
             ) as e:
+                self.game.record_retry()
                 write_jsonl_single_line(
                     data={
                         'messages': messages,
@@ -223,6 +282,13 @@ For each function call, return a json object with function name and arguments wi
             audience: Union['Player', List['Player'], None] = None,
             tool: Optional[Tool] = None
     ):
+        return run_sync(self.think_and_speak_async(audience, tool))
+
+    async def think_and_speak_async(
+            self,
+            audience: Union['Player', List['Player'], None] = None,
+            tool: Optional[Tool] = None
+    ):
 
         audience = self.validate_audience(self, audience)
         audience_str = self.audience_str(self, audience)
@@ -239,10 +305,11 @@ For each function call, return a json object with function name and arguments wi
         else:
             prompt += f"output format: {tool.output_format.__name__}"
 
-        thought, content, result = self.generate_thought_and_content(
-            prompt=prompt,
-            tool=tool
-        )
+        thought, content, result = \
+            await self.generate_thought_and_content_async(
+                prompt=prompt,
+                tool=tool
+            )
         self.memory.update_thought(one_line_str(thought))
         logger.info(f'{self} THINKS: "{thought}"')
 
@@ -253,6 +320,9 @@ For each function call, return a json object with function name and arguments wi
         return self.memory.retrieve()
 
     def consolidate_memory(self):
+        return run_sync(self.consolidate_memory_async())
+
+    async def consolidate_memory_async(self):
         prompt = self.memory.retrieve()
         if self.language == "zh":
             prompt += "\n结合你之前的记忆和新增信息，记录从游戏开始到现在发生的事。"
@@ -261,7 +331,8 @@ For each function call, return a json object with function name and arguments wi
         else:
             raise ValueError(f"Unsupported language: {self.language}")
 
-        _, new_memory, _ = self.generate_thought_and_content(prompt)
+        _, new_memory, _ = await self.generate_thought_and_content_async(
+            prompt)
 
         self.memory.consolidate(new_memory)
         logger.info(
@@ -272,7 +343,14 @@ For each function call, return a json object with function name and arguments wi
             choices: List["Player"] = None,
             abstain: bool = True,
     ):
-        target = self.think_and_speak(
+        return run_sync(self.select_one_player_async(choices, abstain))
+
+    async def select_one_player_async(
+            self,
+            choices: List["Player"] = None,
+            abstain: bool = True,
+    ):
+        target = await self.think_and_speak_async(
             audience=self.game.moderator,
             tool=SelectOnePlayer(choices=choices, abstain=abstain)
         )
@@ -281,7 +359,10 @@ For each function call, return a json object with function name and arguments wi
         return target
 
     def decide_binary(self):
-        result = self.think_and_speak(
+        return run_sync(self.decide_binary_async())
+
+    async def decide_binary_async(self):
+        result = await self.think_and_speak_async(
             audience=self.game.moderator,
             tool=DecideBinary()
         )
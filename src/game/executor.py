@@ -0,0 +1,164 @@
+import asyncio
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Awaitable, Callable, List, Optional
+
+
+class SubprocessExecutor:
+    """
+    Runs the concurrent subprocesses of games on a shared thread pool.
+    The size of the pool caps the subprocesses running at once
+    over all games sharing the executor,
+    and max_per_game caps those of a single game.
+    The time a subprocess waits for its turn is reported to its game.
+    Games played on an event loop run their subprocesses as coroutines,
+    under the same caps over the games of the loop.
+    Subclasses may run the subprocesses otherwise by overriding submit.
+    """
+
+    def __init__(
+            self,
+            max_workers: int = 64,
+            max_per_game: Optional[int] = None
+    ):
+        assert max_workers >= 1
+        assert max_per_game is None or max_per_game >= 1
+        self.max_workers = max_workers
+        self.max_per_game = max_per_game
+        self.pool = None
+        self.lock = threading.Lock()
+        # semaphores of the games running subprocesses
+        self.game_slots = weakref.WeakKeyDictionary()
+        # semaphores of the event loops running subprocesses
+        self.loop_slots = weakref.WeakKeyDictionary()
+
+    def get_pool(self) -> ThreadPoolExecutor:
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="subprocess"
+                )
+            return self.pool
+
+    def get_game_slots(self, game) -> Optional[threading.Semaphore]:
+        if self.max_per_game is None:
+            return None
+        with self.lock:
+            slots = self.game_slots.get(game)
+            if slots is None:
+                slots = threading.Semaphore(self.max_per_game)
+                self.game_slots[game] = slots
+            return slots
+
+    def submit(self, game, fn: Callable[[], None]) -> Future:
+        """
+        Run a subprocess of the game.
+        Blocks while the game has max_per_game subprocesses running.
+        """
+        submitted = time.perf_counter()
+        slots = self.get_game_slots(game)
+        if slots is not None:
+            slots.acquire()
+
+        def run():
+            try:
+                game.record_queue_wait(time.perf_counter() - submitted)
+                fn()
+            finally:
+                if slots is not None:
+                    slots.release()
+
+        try:
+            return self.get_pool().submit(run)
+        except BaseException:
+            if slots is not None:
+                slots.release()
+            raise
+
+    def run_all(self, game, fns: List[Callable[[], None]]):
+        """
+        Run the subprocesses of a game concurrently,
+        and wait for all of them to finish.
+        An error of a subprocess is raised once all are finished.
+        """
+        futures = [self.submit(game, fn) for fn in fns]
+        for future in futures:
+            future.exception()
+        for future in futures:
+            future.result()
+
+    def get_loop_slots(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            slots = self.loop_slots.get(loop)
+            if slots is None:
+                slots = asyncio.Semaphore(self.max_workers)
+                self.loop_slots[loop] = slots
+            return slots
+
+    async def run_all_async(
+            self,
+            game,
+            fns: List[Callable[[], Awaitable[None]]]
+    ):
+        """
+        Run the coroutines of the subprocesses of a game concurrently
+        on the running event loop, and wait for all of them to finish.
+        A game runs one step at a time,
+        so the cap per game holds for the subprocesses of this call.
+        An error of a subprocess is raised once all are finished.
+        """
+        loop_slots = self.get_loop_slots()
+        game_slots = asyncio.Semaphore(self.max_per_game) \
+            if self.max_per_game is not None else nullcontext()
+
+        async def run(fn):
+            game.tracer.new_lane("subprocess")
+            submitted = time.perf_counter()
+            async with game_slots, loop_slots:
+                game.record_queue_wait(time.perf_counter() - submitted)
+                await fn()
+
+        results = await asyncio.gather(
+            *(run(fn) for fn in fns), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    def shutdown(self):
+        """
+        Stop the threads of the pool,
+        which is created again by the next subprocess.
+        """
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def __getstate__(self):
+        return {
+            "max_workers": self.max_workers,
+            "max_per_game": self.max_per_game,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+_default_executor = SubprocessExecutor()
+
+
+def get_default_executor() -> SubprocessExecutor:
+    """
+    The executor of games not attached to a sampler.
+    """
+    return _default_executor
+
+
+def set_default_executor(executor: SubprocessExecutor):
+    global _default_executor
+    _default_executor = executor
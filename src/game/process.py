@@ -1,9 +1,10 @@
+import inspect
 import os
 import pickle
 import sys
 from copy import deepcopy
-from threading import Thread
-from typing import Optional
+from threading import Lock
+from typing import Dict, List, Optional
 
 from loguru import logger
 
@@ -14,7 +15,49 @@ from utils.constants import (
     FINISHED,
 )
 from utils.path_manager import get_data_dir
-from utils.utils import unique_identifier
+from utils.tracer import Tracer, get_default_tracer
+from utils.utils import run_sync, unique_identifier
+
+from .executor import SubprocessExecutor, get_default_executor
+
+
+# games rolled out concurrently share the global logger
+_logger_lock = Lock()
+# the sinks of the log files by data directory, shared by the games there
+_logger_sinks: Dict[str, List[int]] = {}
+_console_sink: Optional[int] = None
+
+
+def add_log_sinks(data_dir: str):
+    """
+    Log to the console and to the log files of the data directory,
+    unless their sinks are added already.
+    The console sink replaces the default one of the logger, once.
+    """
+    global _console_sink
+    with _logger_lock:
+        if _console_sink is None:
+            try:
+                logger.remove(0)
+            except ValueError:
+                pass
+            _console_sink = logger.add(sys.stdout, level="DEBUG")
+        if data_dir not in _logger_sinks:
+            _logger_sinks[data_dir] = [
+                logger.add(os.path.join(data_dir, 'info.log'),
+                           format="{message}", level="INFO"),
+                logger.add(os.path.join(data_dir, 'trace.log'),
+                           level="TRACE"),
+            ]
+
+
+def remove_log_sinks(data_dir: str):
+    """
+    Close the log files of the data directory, the console sink is kept.
+    """
+    with _logger_lock:
+        for sink in _logger_sinks.pop(data_dir, []):
+            logger.remove(sink)
 
 
 class Process:
@@ -43,6 +86,34 @@ class Process:
         self.step = 0
         self.locked = False  # for concurrency
 
+    def __getstate__(self):
+        """
+        The default name is left out, it is derived from the id,
+        and so is the index of the subprocesses by name.
+        """
+        state = self.__dict__.copy()
+        if state.get("name") == f'{self.__class__.__name__}_{self._id}':
+            del state["name"]
+        state.pop("_Process__name_to_sub", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "name" not in state:
+            self.name = f'{self.__class__.__name__}_{self._id}'
+        if "_Process__name_to_sub" not in state:
+            # rebuilt once needed, the subprocesses may not be loaded yet
+            self.__name_to_sub = None
+
+    @property
+    def name_to_sub(self):
+        """
+        Returns the subprocesses by name.
+        """
+        if self.__name_to_sub is None:
+            self.__name_to_sub = {sub.name: sub for sub in self.sub}
+        return self.__name_to_sub
+
     def __str__(self):
         result = []
         curr = self
@@ -90,10 +161,9 @@ class Process:
             name=name,
             **kwargs
         )
+        assert sub.name not in self.name_to_sub
         self.sub.append(sub)
-
-        assert sub.name not in self.__name_to_sub
-        self.__name_to_sub[sub.name] = sub
+        self.name_to_sub[sub.name] = sub
 
         sub.parent = self
         sub.nxt = self
@@ -109,7 +179,7 @@ class Process:
         """
         Find a subprocess by its name.
         """
-        return self.__name_to_sub.get(name)
+        return self.name_to_sub.get(name)
 
     @property
     def active_subprocesses(self):
@@ -183,28 +253,55 @@ class Process:
 
     def execute_subprocesses_concurrent(self):
         """
-        Use threads to run all subprocesses concurrently.
+        Run all subprocesses concurrently on the executor of the game.
         After all subprocesses are finished, returns to the main process.
         """
-        thread_pool = []
-        for sub in self.active_subprocesses:
-            t = Thread(target=sub.run_concurrent)
-            thread_pool.append(t)
-            t.start()
+        self.game.executor.run_all(
+            self.game, [sub.run_concurrent for sub in self.active_subprocesses])
+
+        assert len(self.active_subprocesses) == 0
+
+    async def execute_subprocesses_concurrent_async(self):
+        """
+        Run all subprocesses concurrently as coroutines
+        on the event loop of the game.
+        A game played synchronously runs them on threads instead,
+        its event loop only serves the current step.
+        """
+        if not self.game.asynchronous:
+            self.execute_subprocesses_concurrent()
+            return
 
-        for t in thread_pool:
-            t.join()
+        await self.game.executor.run_all_async(
+            self.game,
+            [sub.run_concurrent_async for sub in self.active_subprocesses]
+        )
 
         assert len(self.active_subprocesses) == 0
 
     def run_current_step(self):
         """
         Run the current step of the process.
+        A step which is a coroutine is run on the event loop of the thread.
         """
         # Get the method corresponding to the current step
         method = self.sequence[self.step]
+        with self.game.tracer.span(self.step_str, "step"):
+            result = method()
+            if inspect.isawaitable(result):
+                run_sync(result)
         # Increment the step counter
-        method()
+        self.step += 1
+
+    async def run_current_step_async(self):
+        """
+        Run the current step of the process on the running event loop.
+        """
+        method = self.sequence[self.step]
+        with self.game.tracer.span(self.step_str, "step"):
+            result = method()
+            if inspect.isawaitable(result):
+                await result
         self.step += 1
 
     def run(self):
@@ -216,6 +313,15 @@ class Process:
         else:
             self.run_current_step()
 
+    async def run_async(self):
+        """
+        Run the process on the running event loop.
+        """
+        if self.step == len(self.sequence):
+            self.exit()
+        else:
+            await self.run_current_step_async()
+
     def run_concurrent(self):
         """
         This method is called to run the process as a concurrent subprocess.
@@ -227,6 +333,17 @@ class Process:
 
         self.locked = True
 
+    async def run_concurrent_async(self):
+        """
+        Run the process as a concurrent subprocess on the running event loop.
+        """
+        if self.step == len(self.sequence):
+            return
+        else:
+            await self.run_current_step_async()
+
+        self.locked = True
+
 
 def checkpoint(func):
     """
@@ -235,19 +352,27 @@ def checkpoint(func):
     it will pause the game for the sampler to save the current state.
     The second time the function is called, it will resume the game,
     and actually run the function.
+    A checkpoint the sampler does not pause at runs the function at once.
+    The function may be a coroutine, which is returned to be awaited.
     """
 
     def wrapper(self: Process, *args, **kwargs):
         wrapper.__name__ = func.__name__
 
         if self.game.node is None:
-            func(self, *args, **kwargs)
+            return func(self, *args, **kwargs)
         elif self.game.status == PLAYING:
+            if not self.game.pauses_at(self, func.__name__):
+                return func(self, *args, **kwargs)
             self.game.status = PAUSED
+            self.game.tracer.instant(
+                "pause", "checkpoint", step=self.step_str)
             self.step -= 1
         elif self.game.status == RESUMED:
             self.game.status = PLAYING
-            func(self, *args, **kwargs)
+            self.game.tracer.instant(
+                "resume", "checkpoint", step=self.step_str)
+            return func(self, *args, **kwargs)
 
     return wrapper
 
@@ -256,35 +381,51 @@ def concurrent_checkpoint(func):
     """
     Decorator to create a checkpoint in the game for concurrent processes.
     This decorator is used to pause the game and save the current state.
+    The function may be a coroutine,
+    then the games of the players are kept once it is finished.
+    A checkpoint the sampler does not pause at runs the function at once,
+    without keeping the games of the players.
     """
 
     def wrapper(self: Process, *args, **kwargs):
         wrapper.__name__ = func.__name__
 
         if self.game.node is None:
-            func(self, *args, **kwargs)
+            return func(self, *args, **kwargs)
 
         elif self.game.status == PLAYING:
+            if not self.game.pauses_at(self, func.__name__):
+                return func(self, *args, **kwargs)
             self.game.status = PAUSED
+            self.game.tracer.instant(
+                "pause", "checkpoint", step=self.step_str)
             self.step -= 1
 
         else:
             self.game.status = PLAYING
-            orig_game = self.game.clone()
-            active_players = [
-                p.involved[0].id for p in self.game.curr.active_subprocesses]
-            func(self, *args, **kwargs)
-            for i, orig_sub in enumerate(orig_game.curr.sub):
-                if orig_sub.involved[0].id not in active_players:
-                    continue
-                one_old_game = self.game.clone()
-                sub = one_old_game.curr.sub[i]
-                sub.step = 0
-                sub.locked = False
-                orig_player = orig_sub.involved[0]
-                new_player = one_old_game.id_to_player[orig_player.id]
-                new_player.memory = orig_player.memory
-                self.game.node.one_old[orig_player.id] = one_old_game
+            self.game.tracer.instant(
+                "resume", "checkpoint", step=self.step_str)
+            # the memories of the active players before the step
+            old_memories = {
+                i: sub.involved[0].memory.fork()
+                for i, sub in enumerate(self.game.curr.sub) if not sub.locked
+            }
+
+            def keep_one_old():
+                # The games with one player yet to play are kept as deltas
+                # over a single clone of the game after the step.
+                base = self.game.clone()
+                for i, memory in old_memories.items():
+                    self.game.node.add_one_old(
+                        memory.agent.id, base, i, memory)
+
+            result = func(self, *args, **kwargs)
+            if inspect.isawaitable(result):
+                async def run_and_keep_one_old():
+                    await result
+                    keep_one_old()
+                return run_and_keep_one_old()
+            keep_one_old()
 
     return wrapper
 
@@ -311,6 +452,15 @@ class Game(Process):
         self.status = PLAYING
         self.node = None
         self.result = {}
+        # whether the game is played on a running event loop
+        self.asynchronous = False
+        # checkpoints counted by the checkpoint policy of the sampler
+        self.checkpoints = 0
+
+    def __setstate__(self, state):
+        # games pickled before checkpoints were counted
+        state.setdefault("checkpoints", 0)
+        super().__setstate__(state)
 
     def __str__(self):
         return f'{self.name}_{self.id}'
@@ -345,12 +495,10 @@ class Game(Process):
         """
         Initialize the logger for the game.
         The logger is used to log the game events and data.
+        The games of a sampler share its data directory, and its sinks,
+        which are added once, not re-pointed by every rollout.
         """
-        logger.remove()
-        logger.add(sys.stdout, level="DEBUG")
-        logger.add(os.path.join(self.data_dir, 'info.log'),
-                   format="{message}", level="INFO")
-        logger.add(os.path.join(self.data_dir, 'trace.log'), level="TRACE")
+        add_log_sinks(self.data_dir)
 
     @property
     def game(self):
@@ -369,12 +517,61 @@ class Game(Process):
         raise NotImplementedError(
             "Game class should implement observable_state property")
 
+    @property
+    def executor(self) -> SubprocessExecutor:
+        """
+        Returns the executor of the concurrent subprocesses.
+        A game being sampled uses the executor of the sampler,
+        shared by all its rollouts.
+        """
+        if self.node is not None:
+            return self.node.sampler.executor
+        return get_default_executor()
+
+    @property
+    def tracer(self) -> Tracer:
+        """
+        Returns the tracer recording the work of the game.
+        A game being sampled uses the tracer of the sampler.
+        """
+        if self.node is not None:
+            return self.node.sampler.tracer
+        return get_default_tracer()
+
+    @property
+    def replay(self):
+        """
+        Returns the recorded LLM outputs the game is replayed from, if any.
+        """
+        if self.node is not None:
+            return self.node.sampler.replay
+        return None
+
+    def pauses_at(self, process: Process, step: str) -> bool:
+        """
+        Returns whether the game being sampled pauses at the checkpoint
+        of the step of the process, as decided by the checkpoint policy
+        of the sampler.
+        """
+        return self.node.sampler.checkpoint_policy.pauses(self, process, step)
+
+    def fingerprint(self) -> Optional[str]:
+        """
+        Returns a fingerprint of the state of the game,
+        equal for states that are functionally the same,
+        i.e. the game continues from them in the same way.
+        Returns None if the game does not support fingerprints.
+        """
+        return None
+
     def clone(self):
         """
         Clone the game object.
         This method is used to create a copy of the game object.
         If the game is being sampled, it will not clone the node.
         The cloned game object will not be attached to a sampler.
+        The memory logs of the players are immutable and shared with the clone,
+        so only the mutable state of the game is copied.
         """
         node = self.node
         self.node = None
@@ -383,6 +580,20 @@ class Game(Process):
 
         return result
 
+    def fork_subprocess(self, index: int, memory):
+        """
+        Returns a clone of the game in which a concurrent subprocess
+        of the current process is yet to run,
+        with its player given back the memory from before.
+        """
+        game = self.clone()
+        sub = game.curr.sub[index]
+        sub.step = 0
+        sub.locked = False
+        player = sub.involved[0]
+        player.memory = memory.fork(player)
+        return game
+
     def record_detail(self, data):
         """
         Record the detail of a prompt by the agent.
@@ -391,6 +602,28 @@ class Game(Process):
         if self.node is not None:
             self.node.data["detail"].append(data)
 
+    def record_usage(self, usage, seconds=0.):
+        """
+        Record the usage and latency of an LLM call by the agent.
+        This method is used to charge the call to the budget of the sampler.
+        """
+        if self.node is not None:
+            self.node.record_usage(usage, seconds)
+
+    def record_retry(self):
+        """
+        Record a failed LLM call of the agent, which is retried.
+        """
+        if self.node is not None:
+            self.node.record_retry()
+
+    def record_queue_wait(self, seconds):
+        """
+        Record the time a concurrent subprocess waited for the executor.
+        """
+        if self.node is not None:
+            self.node.add_metrics({"subprocesses": 1, "queue_seconds": seconds})
+
     def save(self):
         """
         If the game is being sampled, puts the current process into the sampler.
@@ -409,7 +642,9 @@ class Game(Process):
 
         self.status = FINISHED
         self.curr = None
-        logger.remove()
+        # the sinks of a sampled game are closed when the sampler finishes
+        if self.node is None:
+            remove_log_sinks(self.data_dir)
 
         if os.path.exists(os.path.join(self.data_dir, 'game.pkl')):
             os.rename(os.path.join(self.data_dir, 'game.pkl'),
@@ -419,13 +654,33 @@ class Game(Process):
         """
         Start or resume playing the game.
         """
+        self.asynchronous = False
         while self.curr is not None:
             self.curr.run()
         self.save()
 
+    async def play_async(self):
+        """
+        Start or resume playing the game on the running event loop,
+        which may play many games at once.
+        """
+        self.asynchronous = True
+        while self.curr is not None:
+            await self.curr.run_async()
+        self.save()
+
     def play_to_next_checkpoint(self):
         """
         Play the game until the next checkpoint.
         """
+        self.asynchronous = False
         while self.curr is not None and self.status in (PLAYING, RESUMED):
             self.curr.run()
+
+    async def play_to_next_checkpoint_async(self):
+        """
+        Play the game until the next checkpoint on the running event loop.
+        """
+        self.asynchronous = True
+        while self.curr is not None and self.status in (PLAYING, RESUMED):
+            await self.curr.run_async()
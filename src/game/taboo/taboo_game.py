@@ -91,7 +91,9 @@ class Defender(Player):
 class Moderator(Player):
     """
     Moderator class for the Werewolf game.
+    The moderator never thinks, so it does not remember what it hears.
     """
+    remembers = False
 
     def __init__(self, game: "TabooGame"):
         super().__init__(game=game, player_id=0)
@@ -133,10 +135,10 @@ class AttackerAct(Process):
     """
 
     @checkpoint
-    def speak(self):
+    async def speak(self):
         self.game.round += 1
 
-        content = self.game.attacker.think_and_speak()
+        content = await self.game.attacker.think_and_speak_async()
         self.game.moderator.judge_attacker(content)
 
     @property
@@ -152,8 +154,8 @@ class DefenderAct(Process):
     """
 
     @checkpoint
-    def speak(self):
-        content = self.game.defender.think_and_speak()
+    async def speak(self):
+        content = await self.game.defender.think_and_speak_async()
         self.game.moderator.judge_defender(content)
 
     @property
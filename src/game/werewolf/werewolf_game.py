@@ -13,7 +13,7 @@ from agent import (
     DecideBinary,
     SelectOnePlayer,
 )
-from utils.utils import order_str
+from utils.utils import order_str, stable_hash
 from .werewolf_template import (
     WEREWOLF_GAME_NAME,
     WEREWOLF_INFO,
@@ -44,7 +44,9 @@ class WerewolfGamePlayer(Player):
 class Moderator(WerewolfGamePlayer):
     """
     Moderator class for the Werewolf game.
+    The moderator never thinks, so it does not remember what it hears.
     """
+    remembers = False
 
     def __init__(self, game: "WerewolfGame"):
         super().__init__(game=game, player_id=0)
@@ -127,6 +129,33 @@ def get_role(role_str: str) -> WerewolfGamePlayer:
     return str_to_role.get(role_str)
 
 
+def canonical_state(value):
+    """
+    Convert a value of the game state to a canonical JSON serializable form,
+    players are referred to by their names.
+    """
+    if isinstance(value, Player):
+        return str(value)
+    if isinstance(value, Process):
+        return {
+            "process": value.__class__.__name__,
+            "step": value.step,
+            "locked": value.locked,
+            "payload": canonical_state(value.payload),
+            "sub": canonical_state(value.sub),
+        }
+    if isinstance(value, dict):
+        return {
+            str(canonical_state(k)): canonical_state(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [canonical_state(x) for x in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
 class WerewolfGameProcess(Process):
     """
     Base class for all processes in the Werewolf game.
@@ -241,8 +270,8 @@ class HunterKill(WerewolfGameProcess):
         )
 
     @checkpoint
-    def select(self):
-        target = self.hunter.select_one_player(
+    async def select(self):
+        target = await self.hunter.select_one_player_async(
             choices=self.game.alive_players,
             abstain=True
         )
@@ -277,9 +306,9 @@ class SheriffSuccession(WerewolfGameProcess):
         )
 
     @checkpoint
-    def select(self):
+    async def select(self):
         dead_sheriff = self.game.sheriff
-        target = dead_sheriff.select_one_player(
+        target = await dead_sheriff.select_one_player_async(
             choices=self.game.alive_players,
             abstain=True
         )
@@ -346,8 +375,8 @@ class Die(WerewolfGameProcess):
 
 
 class Consolidate(WerewolfGameProcess):
-    def consolidate(self):
-        self.involved[0].consolidate_memory()
+    async def consolidate(self):
+        await self.involved[0].consolidate_memory_async()
 
     @property
     def sequence(self):
@@ -366,8 +395,8 @@ class MemoryConsolidation(WerewolfGameProcess):
             )
 
     @concurrent_checkpoint
-    def concurrent_consolidate(self):
-        self.execute_subprocesses_concurrent()
+    async def concurrent_consolidate(self):
+        await self.execute_subprocesses_concurrent_async()
 
     @property
     def sequence(self):
@@ -383,8 +412,8 @@ class Speak(WerewolfGameProcess):
         self.speaker = kwargs.get('speaker')
 
     @checkpoint
-    def speak(self):
-        self.speaker.think_and_speak(self.involved)
+    async def speak(self):
+        await self.speaker.think_and_speak_async(self.involved)
 
     @property
     def sequence(self):
@@ -398,9 +427,9 @@ class Vote(WerewolfGameProcess):
         super().__init__(*args, **kwargs)
         self.abstain = kwargs.get('abstain', True)
 
-    def select(self):
+    async def select(self):
         voter = self.involved[0]
-        self.payload[voter] = voter.select_one_player(
+        self.payload[voter] = await voter.select_one_player_async(
             choices=self.game.alive_players,
             abstain=self.abstain
         )
@@ -437,8 +466,8 @@ class Voting(WerewolfGameProcess):
             )
 
     @concurrent_checkpoint
-    def concurrent_vote(self):
-        self.execute_subprocesses_concurrent()
+    async def concurrent_vote(self):
+        await self.execute_subprocesses_concurrent_async()
 
     def announce_votes(
         self,
@@ -446,8 +475,9 @@ class Voting(WerewolfGameProcess):
         audience: Optional[List[WerewolfGamePlayer]] = None,
     ) -> List[WerewolfGamePlayer]:
 
+        # votes are cast concurrently, and announced in the order of voters
         target_to_voter = {}
-        for voter, target in votes.items():
+        for voter, target in sorted(votes.items(), key=lambda x: x[0].id):
             if target not in target_to_voter:
                 target_to_voter[target] = []
             target_to_voter[target].append(voter)
@@ -536,16 +566,16 @@ class SeerAct(WerewolfGameProcess):
         self.moderator.speak("你要查验谁？输出目标序号。", self.seer)
 
     @checkpoint
-    def select(self):
-        target = self.seer.select_one_player(
+    async def select(self):
+        target = await self.seer.select_one_player_async(
             choices=self.game.alive_players,
             abstain=False
         )
         self.moderator.speak(f"{target}是{target.team}。", self.seer)
 
     @checkpoint
-    def consolidate(self):
-        self.seer.consolidate_memory()
+    async def consolidate(self):
+        await self.seer.consolidate_memory_async()
 
     @property
     def sequence(self):
@@ -617,9 +647,9 @@ class Heal(WerewolfGameProcess):
             self.victim_exists = False
 
     @checkpoint
-    def decide(self):
+    async def decide(self):
         if self.victim_exists:
-            result = self.witch.decide_binary()
+            result = await self.witch.decide_binary_async()
             self.payload['heal'] = result
             if result:
                 self.witch.healing_remain = False
@@ -642,8 +672,8 @@ class Poison(WerewolfGameProcess):
         )
 
     @checkpoint
-    def select(self):
-        result = self.witch.select_one_player(
+    async def select(self):
+        result = await self.witch.select_one_player_async(
             choices=self.game.alive_players,
             abstain=True
         )
@@ -681,8 +711,8 @@ class WitchAct(WerewolfGameProcess):
         self.clear_subprocesses()
 
     @checkpoint
-    def consolidate(self):
-        self.witch.consolidate_memory()
+    async def consolidate(self):
+        await self.witch.consolidate_memory_async()
 
     @property
     def sequence(self):
@@ -914,6 +944,29 @@ class WerewolfGame(Game):
             result += f"警长是{self.sheriff}。"
         return result
 
+    def fingerprint(self):
+        """
+        The fingerprint covers the processes of the game with their steps and
+        payloads, the facts of the game, and what every player has heard.
+        The thoughts of the players are left out,
+        so players voting or deciding the same for different reasons
+        lead to the same state.
+        """
+        state = {
+            "round": self.round,
+            "curr": self.curr.step_str if self.curr is not None else None,
+            "processes": canonical_state(self),
+            "alive": canonical_state(self.alive_players),
+            "sheriff": canonical_state(self.sheriff),
+            "witch": [
+                self.witch.healing_remain, self.witch.poison_remain
+            ] if self.witch is not None else None,
+            "memory": {
+                str(player): player.memory.heard() for player in self.players
+            },
+        }
+        return stable_hash(state)
+
     @property
     def is_over(self):
         if len(self.villagers) == 0:
@@ -1,11 +1,31 @@
 from .sampler import (
     GameSampler,
     reconstruct_game_sampler_for_display,
-    reconstruct_game_sampler_for_sampling
+    reconstruct_game_sampler_for_sampling,
+    replay_game_sampler,
+    resume_game_sampler
+)
+from .checkpoint import CheckpointPolicy
+from .replay import Replay
+from .strategy import (
+    LevelBanditStrategy,
+    SamplingStrategy,
+    UCTStrategy,
+    UniformStrategy,
+    VarianceStrategy
 )
 
 __all__ = [
     "GameSampler",
     "reconstruct_game_sampler_for_display",
-    "reconstruct_game_sampler_for_sampling"
+    "reconstruct_game_sampler_for_sampling",
+    "replay_game_sampler",
+    "resume_game_sampler",
+    "CheckpointPolicy",
+    "Replay",
+    "LevelBanditStrategy",
+    "SamplingStrategy",
+    "UCTStrategy",
+    "UniformStrategy",
+    "VarianceStrategy"
 ]
@@ -0,0 +1,110 @@
+import threading
+import time
+from typing import Dict, Optional
+
+
+class Budget:
+    """
+    Limits on the resources a sampling run may spend.
+    A limit of None means no limit.
+    The usage of LLM calls is recorded by the players of the sampled games,
+    possibly from several threads at once.
+    """
+
+    def __init__(
+            self,
+            max_llm_calls: Optional[int] = None,
+            max_tokens: Optional[int] = None,
+            max_seconds: Optional[float] = None
+    ):
+        self.max_llm_calls = max_llm_calls
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.llm_calls = 0
+        self.tokens = 0
+        # seconds spent before the current run
+        self.seconds = 0.
+        self.started = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["seconds"] = self.elapsed
+        state["started"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @property
+    def elapsed(self) -> float:
+        """
+        Seconds spent by all runs so far.
+        """
+        if self.started is None:
+            return self.seconds
+        return self.seconds + time.monotonic() - self.started
+
+    def start(self):
+        """
+        Start the clock of a run.
+        """
+        if self.started is None:
+            self.started = time.monotonic()
+
+    def stop(self):
+        """
+        Stop the clock of a run.
+        """
+        self.seconds = self.elapsed
+        self.started = None
+
+    def restore(self, usage: Dict):
+        """
+        Restore the usage of previous runs.
+        """
+        self.llm_calls = usage.get("llm_calls", 0)
+        self.tokens = usage.get("tokens", 0)
+        self.seconds = usage.get("seconds", 0.)
+
+    def record(self, usage: Dict[str, int]):
+        """
+        Record an LLM call and the tokens it used.
+        """
+        with self.lock:
+            self.llm_calls += 1
+            self.tokens += usage.get("total_tokens", 0)
+
+    def add(self, usage: Dict[str, int]):
+        """
+        Add the usage spent elsewhere, e.g. by a worker process.
+        """
+        with self.lock:
+            self.llm_calls += usage.get("llm_calls", 0)
+            self.tokens += usage.get("tokens", 0)
+
+    def exhausted(self) -> Optional[str]:
+        """
+        Returns the name of the first exhausted limit,
+        or None if the budget is not exhausted.
+        """
+        if self.max_llm_calls is not None \
+                and self.llm_calls >= self.max_llm_calls:
+            return "max_llm_calls"
+        if self.max_tokens is not None \
+                and self.tokens >= self.max_tokens:
+            return "max_tokens"
+        if self.max_seconds is not None \
+                and self.elapsed >= self.max_seconds:
+            return "max_seconds"
+        return None
+
+    @property
+    def usage(self) -> Dict:
+        return {
+            "llm_calls": self.llm_calls,
+            "tokens": self.tokens,
+            "seconds": round(self.elapsed, 3),
+        }
@@ -0,0 +1,70 @@
+from typing import Iterable, Optional, Union
+
+from game import Game, Process
+
+
+class CheckpointPolicy:
+    """
+    Decides at which checkpoints a game being sampled pauses,
+    i.e. which checkpoints become nodes of the tree.
+    A checkpoint the game does not pause at runs straight through,
+    so it can not be branched from.
+
+    Checkpoints are chosen by the class of their process or the name of
+    their step, e.g. "Speak" or "speak":
+    with include, only the checkpoints matching it are taken,
+    and with exclude, the checkpoints matching it are left out.
+    Of the checkpoints taken, the game pauses at every n-th one,
+    counted over the whole game, starting with the first.
+    The default policy pauses at every checkpoint.
+    """
+
+    def __init__(
+            self,
+            include: Optional[Iterable[str]] = None,
+            exclude: Optional[Iterable[str]] = None,
+            every: int = 1
+    ):
+        assert every >= 1
+        self.include = set(include) if include is not None else None
+        self.exclude = set(exclude) if exclude is not None else set()
+        self.every = every
+
+    @property
+    def config(self) -> dict:
+        return {
+            "include": sorted(self.include)
+            if self.include is not None else None,
+            "exclude": sorted(self.exclude),
+            "every": self.every,
+        }
+
+    def matches(self, process: Process, step: str) -> bool:
+        names = {process.__class__.__name__, step}
+        if self.include is not None and not names & self.include:
+            return False
+        return not names & self.exclude
+
+    def pauses(self, game: Game, process: Process, step: str) -> bool:
+        """
+        Whether the game pauses at the checkpoint of the step of the process.
+        The checkpoints taken are counted by the game,
+        so a resumed game keeps counting where it was paused.
+        """
+        if not self.matches(process, step):
+            return False
+        count = game.checkpoints
+        game.checkpoints += 1
+        return count % self.every == 0
+
+
+def create_checkpoint_policy(
+        policy: Union[dict, CheckpointPolicy, None] = None
+) -> CheckpointPolicy:
+    """
+    Create a checkpoint policy from its config,
+    or return the given policy as is.
+    """
+    if isinstance(policy, CheckpointPolicy):
+        return policy
+    return CheckpointPolicy(**(policy or {}))
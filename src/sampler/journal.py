@@ -0,0 +1,189 @@
+import json
+import os
+from typing import Dict, Iterator, Optional, Tuple
+
+
+def apply_line(records: Dict[str, Dict], line: Dict):
+    """
+    Apply a line of the journal to the latest records of the nodes.
+    A tombstone removes the record of the node.
+    An update merges its fields into the record, the data field by field.
+    A record replaces the record of the node,
+    but keeps its detail if it leaves it out.
+    """
+    node_id = line["id"]
+    if line.get("removed"):
+        records.pop(node_id, None)
+        return
+    record = records.get(node_id)
+    if line.get("update"):
+        if record is not None:
+            record["data"].update(line["data"])
+        return
+    if record is not None and "detail" not in line["data"] \
+            and "detail" in record["data"]:
+        line["data"]["detail"] = record["data"]["detail"]
+    records[node_id] = line
+
+
+class Journal:
+    """
+    An append-only log of node records.
+    Each line of the journal is either a record of a node,
+    an update of some fields of its data,
+    or a tombstone marking the node as removed.
+    The detail of a node is appended once it is played,
+    and left out of its later records.
+    Replaying the journal gives the archive of the sampler.
+
+    The journal is compacted once it holds more than twice as many lines
+    as there are live nodes, so the total cost of appending stays linear.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            min_compaction_size: int = 1000
+    ):
+        self.path = path
+        self.min_compaction_size = min_compaction_size
+        self.file = None
+        # the number of detail records appended, by live node
+        self.live: Dict[str, int] = {}
+        self.size = 0
+        for line in self.read_lines():
+            self.size += 1
+            self.track(line)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["file"] = None
+        return state
+
+    def read_lines(self) -> Iterator[Dict]:
+        """
+        Read the records in the journal in order.
+        A truncated last line, left by a crash, is ignored.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    break
+
+    def track(self, line: Dict):
+        if line.get("removed"):
+            self.live.pop(line["id"], None)
+        elif "detail" in line["data"]:
+            self.live[line["id"]] = len(line["data"]["detail"])
+        elif not line.get("update"):
+            self.live.setdefault(line["id"], 0)
+
+    def write(self, line: Dict):
+        if self.file is None:
+            # line buffered, so a record survives a crash of the process
+            self.file = open(self.path, 'a', encoding='utf-8', buffering=1)
+        self.file.write(json.dumps(line, ensure_ascii=False) + '\n')
+        self.size += 1
+        self.track(line)
+        if self.size > max(self.min_compaction_size, 2 * len(self.live)):
+            self.compact()
+
+    def append(self, record: Dict):
+        """
+        Append the latest record of a node.
+        The detail of a node only grows while it is played,
+        so it is left out if as many records of it were appended already.
+        """
+        detail = record["data"].get("detail")
+        if detail is not None and self.live.get(record["id"]) == len(detail):
+            data = {k: v for k, v in record["data"].items() if k != "detail"}
+            record = dict(record, data=data)
+        self.write(record)
+
+    def update(self, node_id: str, data: Dict):
+        """
+        Append an update of some fields of the data of a node.
+        """
+        self.write({"id": node_id, "update": True, "data": data})
+
+    def remove(self, node_id: str):
+        """
+        Append a tombstone of a removed node.
+        """
+        self.write({"id": node_id, "removed": True})
+
+    def replay(self) -> Dict[str, Dict]:
+        """
+        Replay the journal and return the latest record of each live node,
+        in the order the nodes were first recorded.
+        """
+        self.flush()
+        archive = {}
+        for line in self.read_lines():
+            apply_line(archive, line)
+        return archive
+
+    def compact(self):
+        """
+        Rewrite the journal with only the latest record of each live node.
+        """
+        archive = self.replay()
+        self.close()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for record in archive.values():
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.size = len(archive)
+        self.live = {
+            node_id: len(record["data"].get("detail", []))
+            for node_id, record in archive.items()
+        }
+
+    def flush(self):
+        """
+        Flush the appended records to disk.
+        """
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+def read_journal(path: str) -> Optional[Dict[str, Dict]]:
+    """
+    Replay the journal at the given path.
+    Returns None if there is no journal.
+    """
+    if not os.path.exists(path):
+        return None
+    return Journal(path).replay()
+
+
+def iter_journal(path: str) -> Iterator[Tuple[Dict, Tuple[int, int]]]:
+    """
+    Iterate over the lines of the journal at the given path in order,
+    with the span of each line in the file as (offset, length) in bytes.
+    A truncated last line, left by a crash, is ignored.
+    """
+    if not os.path.exists(path):
+        return
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                yield json.loads(line), (offset, len(line))
+            except json.JSONDecodeError:
+                break
+            offset += len(line)
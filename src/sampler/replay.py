@@ -0,0 +1,72 @@
+import re
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+from utils.exceptions import ReplayExhausted
+
+
+def parse_output(output: str) -> Tuple[str, str]:
+    """
+    Split a recorded output into the thought and the content.
+    """
+    match = re.fullmatch(r"<think>\n(.*)\n</think>\n(.*)", output, re.DOTALL)
+    if match is None:
+        return "", output
+    return match.group(1), match.group(2)
+
+
+class Replay:
+    """
+    The LLM outputs recorded in the archive of a sampling run,
+    served to the players instead of calling the API.
+    Outputs are keyed by the step and the player.
+    Of the outputs of a key not served yet,
+    the first one recorded for the same prompt is served,
+    or else the first one of the key.
+    """
+
+    def __init__(self):
+        self.outputs: Dict[Tuple[str, int], List[dict]] = {}
+        # outputs served, and those served for another prompt
+        self.served = 0
+        self.mismatches = 0
+        self.lock = threading.Lock()
+
+    def add(self, detail: Iterable[dict]):
+        """
+        Add the detail records of a node.
+        """
+        with self.lock:
+            for record in detail:
+                # records of the game itself, e.g. the roles dealt
+                if "output" not in record:
+                    continue
+                key = (record["curr"], record["player"])
+                self.outputs.setdefault(key, []).append(record)
+
+    def generate(self, curr: str, player: int, prompt: str):
+        """
+        Serve the output for the player at the step,
+        in the form returned by the generate functions of the agents.
+        """
+        with self.lock:
+            records = self.outputs.get((curr, player))
+            if not records:
+                raise ReplayExhausted(
+                    f"No recorded output left for player {player} at {curr}")
+            index = next(
+                (i for i, record in enumerate(records)
+                 if record["prompt"] == prompt),
+                None
+            )
+            if index is None:
+                index = 0
+                self.mismatches += 1
+            record = records.pop(index)
+            self.served += 1
+        thought, content = parse_output(record["output"])
+        return thought, content, record["output"], {}
+
+    @property
+    def remaining(self) -> int:
+        return sum(len(records) for records in self.outputs.values())
@@ -1,12 +1,20 @@
+import asyncio
 import os
-import random
+import sys
+import threading
+import time
 from collections import deque
-from typing import Optional, Deque
+from collections.abc import Mapping
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import (
+    Dict, Deque, Iterable, Iterator, List, Optional, Tuple, Union)
 
 import pandas as pd
 from loguru import logger
 
 from game import Game
+from game.executor import SubprocessExecutor
+from game.process import remove_log_sinks
 from utils.constants import (
     BRANCHABLE,
     UNBRANCHABLE,
@@ -19,17 +27,27 @@ from utils.constants import (
 )
 from utils.path_manager import (
     get_data_dir,
-    copy,
     validate_dir,
-    remove,
 )
 from utils.utils import (
     unique_identifier,
-    read_pickle,
     save_pickle,
     read_json,
+    read_json_span,
     save_json,
+    iter_json_object,
 )
+from utils.tracer import Tracer, get_default_tracer
+from .journal import Journal, apply_line, iter_journal
+from .replay import Replay
+from .budget import Budget
+from .checkpoint import CheckpointPolicy, create_checkpoint_policy
+from .snapshot import create_snapshot_store
+from .stats import add_metrics, confidence_width, new_stats, update_stats
+from .strategy import SamplingStrategy, create_sampling_strategy
+
+# node id, record, and where to load the detail of the record from
+ArchiveItem = Tuple[str, dict, Optional[Tuple[str, Tuple[int, int]]]]
 
 
 class GameNode:
@@ -38,28 +56,58 @@ class GameNode:
     Each node represents a state of the game.
     The node contains the game object, its status,
     and the data from the current process.
+    Nodes have slots instead of a __dict__, since a sampler may hold
+    millions of them, and the data of a node is kept only in the node.
     """
 
+    __slots__ = (
+        "id",
+        "parent",
+        "root",
+        "level",
+        "depth",
+        "children",
+        "sampler",
+        # sample mode
+        "game",
+        "_branch_status",
+        "game_status",
+        "data",
+        "one_old",
+        "one_old_detail",
+        "fan_out",
+        "settled",
+        # display mode
+        "display",
+        "detail_source",
+    )
+
     def __init__(
             self,
             sampler: "GameSampler",
             parent: Optional["GameNode"] = None,
             game: Optional[Game] = None,
             mode: str = "sample",
+            node_id: Optional[str] = None,
     ):
-        self.id = unique_identifier()
-
-        self.parent = parent
-        if parent is not None:
-            self.parent.children.append(self)
-
+        self.id = node_id if node_id is not None else unique_identifier()
+
+        # The root, level and depth are stored,
+        # and updated when the node is attached or an ancestor is branched.
+        self.parent = None
+        self.root = self
+        self.level = 0
+        self.depth = 0
         self.children = []
 
         self.sampler = sampler
-        self.sampler.add_node(self)
+        with self.sampler.lock:
+            if parent is not None:
+                parent.add_child(self)
+            self.sampler.add_node(self)
 
         if mode == "sample":
-            self.game = game
+            self.game = None
 
             self.branch_status = BRANCHABLE
             self.game_status = UNPLAYED
@@ -69,22 +117,95 @@ class GameNode:
                 "observable_state": None,
             }
 
-            # for concurrent sampling
-            self.one_old = {}
+            # for concurrent sampling, created when needed
+            self.one_old = None
+            # the number of detail records once the concurrent step is played
+            self.one_old_detail = 0
+            # whether the fan-out of a concurrent step is yet to be created,
+            # recorded for a resumed run to play the step again
+            self.fan_out = False
 
-            if self.game is not None:
-                self.offload_game()
+            # whether the branching points of a finished leaf are sampled
+            self.settled = False
+
+            if game is not None:
+                self.set_game(game=game)
 
             # self.sampler.update_sample_queue(self)
         else:
             self.display = {}
+            # where to load the detail from, if it is not loaded yet
+            self.detail_source = None
 
     def __str__(self):
         return f"Node {self.id}"
 
+    def display_detail(self, detail: List[dict]):
+        """
+        Show the detail of the node in display mode.
+        A node may hold the records of several steps under a checkpoint
+        policy, they are shown in order, with their keys numbered.
+        """
+        if len(detail) == 1:
+            self.display.update(detail[0])
+            return
+        for i, record in enumerate(detail, 1):
+            for key, value in record.items():
+                self.display[f"{key} ({i})"] = value
+
+    def load_detail(self):
+        """
+        Load the detail of a node reconstructed for display,
+        if it was left in the archive.
+        """
+        if self.detail_source is not None:
+            path, span = self.detail_source
+            self.display_detail(read_json_span(path, span)["data"]["detail"])
+            self.detail_source = None
+
     def __bool__(self):
         return True
 
+    def __getstate__(self):
+        """
+        Live game objects are not pickled with the node,
+        they are persisted in the snapshot store.
+        """
+        state = {
+            name: getattr(self, name)
+            for name in self.__slots__ if hasattr(self, name)
+        }
+        if "game" in state:
+            state["game"] = None
+        if "one_old" in state:
+            state["one_old"] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def add_one_old(self, player_id: int, base: Game, index: int, memory):
+        """
+        Keep the game of a player before a concurrent step,
+        as the delta from the game after the step shared by all players:
+        the index of the subprocess of the player, and its memory.
+        The detail recorded so far is that of the step,
+        the game may play on past checkpoints it does not pause at.
+        """
+        if self.one_old is None:
+            self.one_old = {}
+        self.one_old[player_id] = (base, index, memory)
+        self.one_old_detail = len(self.data["detail"])
+        self.fan_out = True
+
+    def get_one_old(self, player_id: int) -> Game:
+        """
+        Rebuild the game of a player before a concurrent step.
+        """
+        base, index, memory = self.one_old[player_id]
+        return base.fork_subprocess(index, memory)
+
     @property
     def is_root(self):
         """
@@ -93,44 +214,78 @@ class GameNode:
         return self.parent is None
 
     @property
-    def root(self):
+    def is_leaf(self):
         """
-        Returns the root node of the tree.
+        A node is leaf if it has no children.
         """
-        curr = self
-        while curr.parent is not None:
-            curr = curr.parent
-        return curr
+        return len(self.children) == 0
 
     @property
-    def is_leaf(self):
+    def is_terminal(self):
         """
-        A node is leaf if it has no children.
+        A node is terminal if its rollout ended there:
+        either the game is finished,
+        or the result was taken over from an equivalent node.
         """
-        return len(self.children) == 0
+        return self.game_status == FINISHED or "transposition" in self.data
 
     @property
-    def level(self):
+    def outcomes(self) -> Dict[str, float]:
         """
-        Returns the level of the node.
-        Level of the node equals to the number of steps from the root.
-        Level of the root is 0.
+        The outcomes of the rollouts through the node:
+        the results of the games finished below it,
+        plus the shares of the rollouts transposed below it.
         """
-        if self.is_root:
-            return 0
-        return self.parent.level + 1
+        transposed = self.data.get("transposed")
+        if not transposed:
+            return self.data["result"]
+        outcomes = dict(self.data["result"])
+        add_metrics(outcomes, transposed)
+        return outcomes
 
     @property
-    def depth(self):
+    def branch_status(self):
+        """
+        Returns the branch status of the node.
+        """
+        return self._branch_status
+
+    @branch_status.setter
+    def branch_status(self, status: str):
+        """
+        Set the branch status of the node, and update the sampler index.
+        Branching a node changes the depth of all its descendants.
         """
+        old_status = getattr(self, "_branch_status", None)
+        self._branch_status = status
+        self.sampler.index_branch_status(self, old_status, status)
+        if (old_status == BRANCHED) != (status == BRANCHED):
+            for child in self.children:
+                child.update_position()
+
+    def update_position(self):
+        """
+        Update the stored root, level and depth of the node
+        and its descendants from their parents.
+        Level of the node equals to the number of steps from the root.
+        Level of the root is 0.
         Depth is defined as branches from root to node (excluding the node).
         """
-        if self.parent is None:
-            return 0
-        elif self.parent.branch_status == BRANCHED:
-            return self.parent.depth + 1
-        else:
-            return self.parent.depth
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            parent = node.parent
+            if parent is None:
+                node.root = node
+                node.level = 0
+                node.depth = 0
+            else:
+                node.root = parent.root
+                node.level = parent.level + 1
+                node.depth = parent.depth
+                if getattr(parent, "branch_status", None) == BRANCHED:
+                    node.depth += 1
+            stack.extend(node.children)
 
     @property
     def depth_remain(self):
@@ -150,6 +305,7 @@ class GameNode:
         """
         self.children.remove(child)
         child.parent = None
+        child.update_position()
 
     def add_child(self, child: "GameNode"):
         """
@@ -159,20 +315,13 @@ class GameNode:
             child.parent.remove_child(child)
         self.children.append(child)
         child.parent = self
-
-    @property
-    def game_path(self):
-        """
-        Returns the path to the game pickle file.
-        The path is constructed using the game directory and the node id.
-        """
-        return os.path.join(self.sampler.game_dir, f"{self.id}.pkl")
+        child.update_position()
 
     def load_game(self):
         """
-        Load the game from the pickle file.
+        Load the game from the snapshot store.
         """
-        self.game = read_pickle(self.game_path)
+        self.game = self.sampler.snapshots.load(self.id)
         # link the game to the node
         self.game.node = self
         # The game is resumed by setting the status to RESUMED.
@@ -187,81 +336,176 @@ class GameNode:
             ...
         else:
             self.data["observable_state"] = self.game.observable_state
+        if self.sampler.transposition:
+            self.sampler.index_fingerprint(self, self.game.fingerprint())
 
-    def update_data(self):
+    def record_usage(self, usage: dict, seconds: float = 0.):
         """
-        Update the data of the node.
-        The data is a dictionary of player id to score.
-        The data is updated in the sampler.
+        Record the usage and latency of an LLM call made while playing the game.
+        Calls served by a replay are not charged to the budget.
+        """
+        if self.sampler.replay is None:
+            self.sampler.budget.record(usage)
+        metrics = {"llm_calls": 1, "llm_seconds": seconds}
+        metrics.update({
+            k: v for k, v in usage.items() if isinstance(v, (int, float))})
+        self.add_metrics(metrics)
+
+    def record_retry(self):
+        """
+        Record a failed LLM call made while playing the game.
+        """
+        self.add_metrics({"retries": 1})
+
+    def add_metrics(self, metrics: dict):
+        """
+        Add to the metrics of the node.
+        Players of a concurrent step record their calls from several threads.
+        """
+        with self.sampler.lock:
+            add_metrics(self.data.setdefault("metrics", {}), metrics)
+
+    def record(self, flat: bool = True) -> dict:
+        """
+        Returns the record of the node in the archive.
+        The fields of the data are repeated in the record,
+        as columns of the exported table, unless flat is False.
         """
-        self.sampler.data[self.id] = {
+        record = {
             "id": self.id,
             "parent_id": self.parent.id if self.parent is not None else None,
             "branch_status": self.branch_status,
             "game_status": self.game_status,
             "level": self.level,
+            "settled": self.settled,
+            "fan_out": self.fan_out,
             "data": self.data,
         }
-        for k, v in self.data.items():
-            self.sampler.data[self.id][k] = v
+        if flat:
+            for k, v in self.data.items():
+                record[k] = v
+        return record
 
-    def record_result(self):
+    def update_data(self, *fields: str):
         """
-        Record the result of the game.
+        Update the data of the node.
+        The data is a dictionary of player id to score.
+        The data is updated in the sampler,
+        only the given fields of the data if any.
+        """
+        self.sampler.update_record(self, fields)
+
+    def game_result(self) -> dict:
+        """
+        Returns the result of the finished game of the node.
         The result is a dictionary of player id to score.
-        The result is recorded in the node and its ancestors.
         """
         if self.game is None:
             self.load_game()
         result = self.game.result
         self.offload_game()
-        curr = self
-        while curr is not None:
-            for k, v in result.items():
-                result_dict = curr.data["result"]
-                if k not in result_dict:
-                    result_dict[k] = v
-                else:
-                    result_dict[k] += v
-            curr.update_data()
-            curr = curr.parent
+        return result
+
+    def record_result(self, result: dict):
+        """
+        Record the result of the game.
+        The result is recorded in the node and its ancestors.
+        """
+        self.add_result(result)
         logger.info(f"Recorded result: {result}")
 
-    def offload_game(self):
+    def add_result(
+            self,
+            result: dict,
+            metrics: Optional[dict] = None,
+            transposed: bool = False
+    ):
+        """
+        Add the result of a rollout to the node and its ancestors,
+        both to the summed result and to the running statistics.
+        The share of a transposed rollout is summed apart from the results
+        of the games finished, which stay counts of games.
+        The metrics of the nodes are rolled up in the same walk:
+        the nodes played by the rollout have no subtree metrics yet,
+        their subtree is the part of the rollout below them;
+        the metrics of the whole rollout are added to the nodes above.
+        Metrics of the part of the rollout played elsewhere are given.
+        """
+        with self.sampler.lock:
+            total = dict(metrics) if metrics is not None else {}
+            curr = self
+            while curr is not None:
+                if transposed:
+                    result_dict = curr.data.setdefault("transposed", {})
+                else:
+                    result_dict = curr.data["result"]
+                for k, v in result.items():
+                    result_dict[k] = result_dict.get(k, 0) + v
+                update_stats(curr.data.setdefault("stats", new_stats()), result)
+                if "subtree_metrics" not in curr.data:
+                    add_metrics(total, curr.data.get("metrics", {}))
+                    curr.data["subtree_metrics"] = dict(total)
+                else:
+                    add_metrics(curr.data["subtree_metrics"], total)
+                curr.update_data(
+                    "transposed" if transposed else "result",
+                    "stats", "subtree_metrics")
+                curr = curr.parent
+
+    def transpose(self, node: "GameNode"):
+        """
+        End the rollout at this node with the result of an equivalent node.
+        The node counts as one visit,
+        split by the outcome distribution of the equivalent node.
+        """
+        with self.sampler.lock:
+            result = node.outcomes
+            total = sum(result.values())
+            result = {k: v / total for k, v in result.items()}
+            self.data["transposition"] = node.id
+            self.add_result(result, transposed=True)
+        logger.info(f"Transposed to {node}, recorded result: {result}")
+
+    def offload_game(self, persist: bool = True):
         """
-        Offload the game to the pickle file, and update node data.
+        Offload the game to the snapshot store, and update node data.
         An offloaded node is not to be played again.
+        If persist is False, the snapshot on disk is known to be up to date,
+        and the game is only handed back to the store.
         """
         self.record_game_data()
         self.game.node = None
-        save_pickle(self.game, self.game_path)
+        self.sampler.snapshots.save(self.id, self.game, persist=persist)
         self.game = None
         self.update_data()
 
     def set_game(
             self,
             game: Optional[Game] = None,
-            game_path: Optional[str] = None,
-            offload: bool = True
+            node: Optional["GameNode"] = None,
+            offload: bool = True,
+            clone: bool = True
     ):
         """
         Set the game of the node.
-        If game_path is provided, load the game from the path.
+        If node is provided, the node takes over the snapshot of that node.
+        If clone is False, the node takes the game itself,
+        which must not be used elsewhere.
         """
-        if game_path is not None:
-            remove(self.game_path)
-            copy(game_path, self.game_path)
-            self.game = read_pickle(game_path)
+        if node is not None:
+            self.sampler.snapshots.link(node.id, self.id)
+            self.game = self.sampler.snapshots.load(self.id)
             self.game.node = self
             if offload:
-                self.offload_game()
+                # the linked snapshot is already on disk
+                self.offload_game(persist=False)
         elif game is not None:
-            self.game = game.clone()
+            self.game = game.clone() if clone else game
             self.game.node = self
             if offload:
                 self.offload_game()
         else:
-            raise ValueError("Either game or game_path must be provided.")
+            raise ValueError("Either game or node must be provided.")
 
     def create_child(self):
         """
@@ -273,10 +517,10 @@ class GameNode:
             sampler=self.sampler,
             parent=self
         )
-        # The game pickle file of the current node is copied to the child node.
+        # The game snapshot of the current node is linked to the child node.
         # The child node is not played yet, so its status remains UNPLAYED.
         child_node.set_game(
-            game_path=self.game_path,
+            node=self,
             offload=True
         )
         return child_node
@@ -284,33 +528,53 @@ class GameNode:
     def create_concurrent_nodes(self):
         """
         Create a concurrent child node from the current node.
+        The parent may be shared with other rollouts,
+        so the nodes are created while holding the sampler lock.
         """
-        curr = self.parent
-        detail = self.data["detail"]
-        self.branch_status = UNBRANCHABLE
-        for player_id, one_old_game in self.one_old.items():
-            child_node = GameNode(
-                sampler=self.sampler,
-                parent=curr
-            )
-            child_node.data["detail"] = [
-                x for x in detail if x["player"] == player_id]
-            child_node.game_status = PLAYED
-
-            curr.set_game(game=one_old_game, offload=True)
-
-            curr = child_node
-
-        curr.set_game(game_path=self.game_path, offload=True)
-        if self.game_status == FINISHED:
-            curr.game_status = FINISHED
-        self.parent.remove_child(self)
-        self.sampler.remove_node(self)
+        with self.sampler.lock:
+            curr = self.parent
+            detail = self.data["detail"][:self.one_old_detail]
+            self.branch_status = UNBRANCHABLE
+            self.fan_out = False
+            for player_id in self.one_old:
+                child_node = GameNode(
+                    sampler=self.sampler,
+                    parent=curr
+                )
+                child_node.data["detail"] = [
+                    x for x in detail if x["player"] == player_id]
+                child_node.game_status = PLAYED
+
+                curr.set_game(
+                    game=self.get_one_old(player_id), offload=True, clone=False)
+
+                curr = child_node
+
+            # the last node takes over what was played after the step
+            curr.data["detail"] += self.data["detail"][self.one_old_detail:]
+            curr.set_game(node=self, offload=True)
+            if self.game_status == FINISHED:
+                curr.game_status = FINISHED
+            # the last node takes over the metrics of the step
+            if "metrics" in self.data:
+                curr.add_metrics(self.data["metrics"])
+                curr.update_data("metrics")
+            self.parent.remove_child(self)
+            self.sampler.remove_node(self)
+            self.sampler.snapshots.remove(self.id)
         return curr
 
-    def roll_out(self):
+    def roll_out(
+            self,
+            horizon: Optional[int] = None
+    ) -> Tuple["GameNode", Union[dict, "GameNode"]]:
         """
         Play the game from the node to the end.
+        Returns the leaf, and the result of the game if it is finished there,
+        or else the node equivalent to the leaf,
+        to be recorded once the rollout is merged, see record_rollout.
+        Only the states of the first horizon rollouts recorded,
+        if given, are looked up for transpositions.
         """
         curr = self
         while True:
@@ -318,8 +582,32 @@ class GameNode:
             if curr.one_old:
                 curr = curr.create_concurrent_nodes()
             if curr.game_status == FINISHED:
-                curr.record_result()
-                return curr
+                return curr, curr.game_result()
+            equivalent = self.sampler.find_transposition(curr, horizon)
+            if equivalent is not None:
+                return curr, equivalent
+            curr = curr.create_child()
+
+    async def roll_out_async(
+            self,
+            horizon: Optional[int] = None
+    ) -> Tuple["GameNode", Union[dict, "GameNode"]]:
+        """
+        Play the game from the node to the end on the running event loop.
+        The rollout is traced in a lane of its own,
+        so it is to be run as a task.
+        """
+        self.sampler.tracer.new_lane(f"rollout {self.id}")
+        curr = self
+        while True:
+            await curr.play_and_save_async()
+            if curr.one_old:
+                curr = curr.create_concurrent_nodes()
+            if curr.game_status == FINISHED:
+                return curr, curr.game_result()
+            equivalent = self.sampler.find_transposition(curr, horizon)
+            if equivalent is not None:
+                return curr, equivalent
             curr = curr.create_child()
 
     def expand(self):
@@ -330,6 +618,7 @@ class GameNode:
         while len(self.children) < self.sampler.max_degree:
             result.append(self.create_child())
         self.branch_status = BRANCHED
+        self.update_data()
         return result
 
     def get_upstream_branchable(self):
@@ -348,15 +637,70 @@ class GameNode:
     def play_and_save(self):
         """
         Play the game to the next checkpoint.
+        The wall time of loading, playing and offloading the game is recorded.
+        """
+        with self.sampler.tracer.span("play", "node", node=self.id):
+            start = time.perf_counter()
+            self.load_game()
+            loaded = time.perf_counter()
+            self.game.play_to_next_checkpoint()
+            self.save_played(start, loaded)
+
+    async def play_and_save_async(self):
+        """
+        Play the game to the next checkpoint on the running event loop.
+        """
+        with self.sampler.tracer.span("play", "node", node=self.id):
+            start = time.perf_counter()
+            self.load_game()
+            loaded = time.perf_counter()
+            await self.game.play_to_next_checkpoint_async()
+            self.save_played(start, loaded)
+
+    def save_played(self, start: float, loaded: float):
         """
-        self.load_game()
-        self.game.play_to_next_checkpoint()
+        Offload the game played to the next checkpoint,
+        and record the wall time of loading, playing and offloading it.
+        """
+        played = time.perf_counter()
 
         if self.game.status == FINISHED:
             self.game_status = FINISHED
         else:
             self.game_status = PLAYED
+        self.add_metrics({
+            "load_seconds": loaded - start,
+            "play_seconds": played - loaded,
+        })
         self.offload_game()
+        self.add_metrics({"offload_seconds": time.perf_counter() - played})
+        self.update_data("metrics")
+
+
+class NodeRecords(Mapping):
+    """
+    A read-only view of the records of the nodes by node id.
+    The records are built from the nodes when accessed.
+    """
+
+    def __init__(self, nodes: Dict[str, GameNode]):
+        self.nodes = nodes
+
+    def __getitem__(self, node_id: str) -> dict:
+        return self.nodes[node_id].record()
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+def initial_snapshot_id(root_id: str) -> str:
+    """
+    The id of the snapshot of the game a run starts from.
+    """
+    return f"{root_id}_initial"
 
 
 class GameSampler:
@@ -372,18 +716,96 @@ class GameSampler:
             max_degree: int = 2,
             sample_id: Optional[str] = None,
             game: Optional[Game] = None,
+            num_workers: int = 1,
+            persistence: str = "full",
+            snapshot_store: str = "pickle",
+            cache_size: int = 0,
+            write_behind: bool = False,
+            snapshot_compression: Optional[str] = None,
+            sampling_strategy: Union[str, SamplingStrategy] = "uniform",
+            max_llm_calls: Optional[int] = None,
+            max_tokens: Optional[int] = None,
+            max_seconds: Optional[float] = None,
+            worker_type: str = "thread",
+            transposition: bool = False,
+            ci_width: Optional[float] = None,
+            ci_z: float = 1.96,
+            ci_min_samples: int = 5,
+            max_concurrent_subprocesses: int = 64,
+            max_subprocesses_per_game: Optional[int] = None,
+            checkpoint_policy: Union[dict, CheckpointPolicy, None] = None,
+            trace: bool = False,
+            replay: Optional[Replay] = None,
+            writer: Optional[str] = None,
     ):
+        assert num_workers >= 1
+        assert persistence in ["full", "journal"]
+        assert worker_type in ["thread", "process", "async"]
         self.name = name
         self.id = sample_id if sample_id is not None else unique_identifier()
         self.max_depth = max_depth
         self.max_degree = max_degree
+        self.num_workers = num_workers
+        self.persistence = persistence
+        self.snapshot_store = snapshot_store
+        self.cache_size = cache_size
+        self.write_behind = write_behind
+        self.snapshot_compression = snapshot_compression
+        self.sampling_strategy = create_sampling_strategy(sampling_strategy)
+        self.budget = Budget(max_llm_calls, max_tokens, max_seconds)
+        self.worker_type = worker_type
+        # Nodes of equivalent game states share a fingerprint,
+        # the first node recorded with a fingerprint is kept in the table,
+        # with the number of rollouts recorded before it.
+        self.transposition = transposition
+        self.transpositions: Dict[str, Tuple[str, int]] = {}
+        self.recorded = 0
+        # A branching point whose confidence interval of the outcome
+        # is narrower than ci_width is not expanded.
+        self.ci_width = ci_width
+        self.ci_z = ci_z
+        self.ci_min_samples = ci_min_samples
+        # runs the concurrent subprocesses of all rollouts,
+        # capping them over all games and per game
+        self.executor = SubprocessExecutor(
+            max_concurrent_subprocesses, max_subprocesses_per_game)
+        # the checkpoints the games pause at, to become nodes
+        self.checkpoint_policy = create_checkpoint_policy(checkpoint_policy)
+        # records spans of the work of the rollouts, saved to trace.json
+        self.tracer = Tracer() if trace else get_default_tracer()
+        # recorded LLM outputs served instead of calling the API
+        self.replay = replay
+        # The name of a worker process writing to the directory of the sampler.
+        # A worker sampler keeps neither a journal nor a config of its own.
+        self.writer = writer
+        # the limit of the budget that stopped the run, if any
+        self.stopped = None
+        self.snapshots = create_snapshot_store(
+            self.game_dir, snapshot_store, cache_size, write_behind, writer,
+            self.tracer, snapshot_compression)
+        # guards the tree and the sampler data against concurrent rollouts
+        self.lock = threading.RLock()
         self.nodes = {}
+        # The sample queue may hold removed nodes, which are skipped.
+        # The frontier holds the ids of the nodes actually waiting in it.
         self.sample_queue: Deque['GameNode'] = deque()
-        self.data = {}
+        self.frontier = set()
+        # finished leaves whose branching points were not expanded
+        self.pending = []
+        # ids of nodes by branch status
+        self.branch_index = {
+            BRANCHABLE: set(),
+            UNBRANCHABLE: set(),
+            BRANCHED: set(),
+        }
         self.curr = None
         self.root = None
-
-        save_json(self.config, os.path.join(self.data_dir, 'config.json'))
+        self.journal = None
+        if self.writer is None:
+            if self.persistence == "journal":
+                self.journal = Journal(
+                    os.path.join(self.data_dir, 'journal.jsonl'))
+            save_json(self.config, os.path.join(self.data_dir, 'config.json'))
 
         if game is not None:
             assert self.name == game.name
@@ -391,13 +813,45 @@ class GameSampler:
                 sampler=self,
                 game=game
             )
+            # the snapshot of the root is rewritten once it is played,
+            # so the game the run starts from is kept for replays
+            self.snapshots.link(
+                self.root.id, initial_snapshot_id(self.root.id))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        del state["snapshots"]
+        state["replay"] = None
+        return state
+
+    def __setstate__(self, state):
+        # samplers pickled before the data became a view
+        state.pop("data", None)
+        # samplers pickled before tracing and compressed snapshots
+        state.setdefault("tracer", get_default_tracer())
+        state.setdefault("checkpoint_policy", CheckpointPolicy())
+        state.setdefault("snapshot_compression", None)
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        self.snapshots = create_snapshot_store(
+            self.game_dir, self.snapshot_store, self.cache_size,
+            self.write_behind, self.writer, self.tracer,
+            self.snapshot_compression)
 
     def remove_node(self, node: "GameNode"):
-        if node.id in self.nodes:
-            del self.nodes[node.id]
-            del self.data[node.id]
-        if node in self.sample_queue:
-            self.sample_queue.remove(node)
+        with self.lock:
+            if node.id in self.nodes:
+                del self.nodes[node.id]
+                if self.journal is not None:
+                    self.journal.remove(node.id)
+            for ids in self.branch_index.values():
+                ids.discard(node.id)
+            self.frontier.discard(node.id)
+            fingerprint = getattr(node, "data", {}).get("fingerprint")
+            entry = self.transpositions.get(fingerprint)
+            if entry is not None and entry[0] == node.id:
+                del self.transpositions[fingerprint]
 
     @property
     def data_dir(self):
@@ -422,17 +876,169 @@ class GameSampler:
             "name": self.name,
             "sample_id": self.id,
             "max_depth": self.max_depth,
-            "max_degree": self.max_degree
+            "max_degree": self.max_degree,
+            "num_workers": self.num_workers,
+            "persistence": self.persistence,
+            "snapshot_store": self.snapshot_store,
+            "cache_size": self.cache_size,
+            "write_behind": self.write_behind,
+            "snapshot_compression": self.snapshot_compression,
+            "sampling_strategy": self.sampling_strategy.name,
+            "max_llm_calls": self.budget.max_llm_calls,
+            "max_tokens": self.budget.max_tokens,
+            "max_seconds": self.budget.max_seconds,
+            "worker_type": self.worker_type,
+            "transposition": self.transposition,
+            "ci_width": self.ci_width,
+            "ci_z": self.ci_z,
+            "ci_min_samples": self.ci_min_samples,
+            "max_concurrent_subprocesses": self.executor.max_workers,
+            "max_subprocesses_per_game": self.executor.max_per_game,
+            "checkpoint_policy": self.checkpoint_policy.config,
+            "trace": self.tracer.enabled,
         }
 
+    @classmethod
+    def from_config(cls, config: dict, **overrides) -> "GameSampler":
+        """
+        Create a game sampler from its configuration, as saved by a run.
+        Settings missing from the configuration of older runs
+        take their defaults.
+        Keyword arguments override the configuration,
+        or give what it does not hold, e.g. the game or the replay.
+        """
+        return cls(**{**config, **overrides})
+
+    def update_record(self, node: GameNode, fields: Iterable[str] = ()):
+        """
+        Update the record of a node.
+        The sampler data is a view over the nodes, so it is always up to date.
+        In journal mode, the record is appended to the journal,
+        or only the given fields of its data, if any.
+        """
+        with self.lock:
+            if self.journal is None:
+                return
+            if fields:
+                self.journal.update(
+                    node.id, {field: node.data[field] for field in fields})
+            else:
+                self.journal.append(node.record(flat=False))
+
+    @property
+    def data(self) -> "NodeRecords":
+        """
+        Returns the records of the nodes by node id.
+        """
+        return NodeRecords(self.nodes)
+
     def add_node(self, node: GameNode):
         """
         Add a node to the sampler.
         If the node is the root, add it to the sample queue.
         """
-        self.nodes[node.id] = node
-        if node.is_root:
-            self.sample_queue.appendleft(node)
+        with self.lock:
+            self.nodes[node.id] = node
+            if node.is_root:
+                self.push_frontier([node])
+
+    def index_branch_status(
+            self,
+            node: GameNode,
+            old_status: Optional[str],
+            new_status: str
+    ):
+        """
+        Move the node to its new branch status in the index.
+        """
+        with self.lock:
+            if old_status is not None:
+                self.branch_index[old_status].discard(node.id)
+            self.branch_index[new_status].add(node.id)
+
+    def index_fingerprint(self, node: GameNode, fingerprint: Optional[str]):
+        """
+        Record the fingerprint of the game state of a node.
+        A concurrent step rewrites the snapshot of its parent,
+        which keeps the fingerprint of the state it was first played to,
+        since its results are those of the rollouts from that state.
+        The node is added to the transposition table once its rollout
+        is recorded, see register_rollout.
+        """
+        with self.lock:
+            node.data.setdefault("fingerprint", fingerprint)
+
+    def register_fingerprint(self, node: GameNode):
+        """
+        Add a node to the transposition table,
+        unless another node with its fingerprint is there already.
+        """
+        fingerprint = node.data.get("fingerprint")
+        if fingerprint is not None:
+            with self.lock:
+                self.transpositions.setdefault(
+                    fingerprint, (node.id, self.recorded))
+
+    def register_rollout(self, leaf: GameNode):
+        """
+        Add the nodes of a recorded rollout to the transposition table.
+        Rollouts are recorded in the order their nodes left the queue,
+        so the table does not depend on which rollouts finish first.
+        """
+        with self.lock:
+            if self.transposition:
+                curr = leaf
+                while curr is not None:
+                    self.register_fingerprint(curr)
+                    curr = curr.parent
+            self.recorded += 1
+
+    def find_transposition(
+            self,
+            node: GameNode,
+            horizon: Optional[int] = None
+    ) -> Optional[GameNode]:
+        """
+        Find a node whose game state is equivalent to that of the given node,
+        and whose rollouts already have results.
+        Only the nodes of the first horizon rollouts recorded, if given,
+        are found, those recorded since the rollout of the node started
+        are not, as they would not be if it had finished first.
+        """
+        with self.lock:
+            entry = self.transpositions.get(node.data.get("fingerprint"))
+            if entry is None:
+                return None
+            node_id, recorded = entry
+            if node_id == node.id \
+                    or (horizon is not None and recorded >= horizon):
+                return None
+            equivalent = self.nodes[node_id]
+            if not equivalent.outcomes:
+                return None
+            return equivalent
+
+    def push_frontier(self, nodes: List[GameNode]):
+        """
+        Add nodes to the end of the sample queue.
+        """
+        with self.lock:
+            for node in nodes:
+                self.frontier.add(node.id)
+                self.sample_queue.appendleft(node)
+
+    def pop_frontier(self) -> Optional[GameNode]:
+        """
+        Take the next node from the sample queue,
+        skipping nodes removed since they were queued.
+        """
+        with self.lock:
+            while self.sample_queue:
+                node = self.sample_queue.pop()
+                if node.id in self.frontier:
+                    self.frontier.remove(node.id)
+                    return node
+        return None
 
     def update_sample_queue(self, node: GameNode):
         """
@@ -440,53 +1046,550 @@ class GameSampler:
         If the node is the root, create a child add it to the sample queue.
         """
         if node.is_root:
-            self.sample_queue.append(node.create_child())
+            child = node.create_child()
+            with self.lock:
+                self.frontier.add(child.id)
+                self.sample_queue.append(child)
 
     def sample_branching_points(self, node: GameNode):
         """
-        Randomly select nodes to branch from the upstream branchable nodes.
+        Select nodes to branch from the upstream branchable nodes
+        with the sampling strategy of the sampler.
         The number of branching points is limited by the depth_remain of the node.
         The nodes are sorted by depth, from leaf to root.
         """
         if node.depth_remain == 0:
             return []
 
-        nodes = node.get_upstream_branchable()
+        with self.lock:
+            converged = self.converged_ancestor(node)
+            if converged is not None:
+                logger.info(
+                    f"Outcome of {converged} has converged, "
+                    f"no branching points sampled.")
+                return []
 
-        if len(nodes) <= node.depth_remain:
-            branching_points = nodes
-        else:
-            branching_points = random.sample(nodes, node.depth_remain)
+            nodes = node.get_upstream_branchable()
+
+            if len(nodes) <= node.depth_remain:
+                branching_points = nodes
+            else:
+                branching_points = self.sampling_strategy.select(
+                    self, node, nodes, node.depth_remain)
 
         branching_points.sort(key=lambda x: x.level)
 
         return branching_points
 
+    def converged(self, node: GameNode) -> bool:
+        """
+        Whether the outcome estimate of a node has converged,
+        i.e. its confidence interval is narrower than ci_width.
+        """
+        if self.ci_width is None:
+            return False
+        stats = node.data.get("stats")
+        if stats is None or stats["n"] < self.ci_min_samples:
+            return False
+        return confidence_width(stats, self.ci_z) < self.ci_width
+
+    def converged_ancestor(self, node: GameNode) -> Optional[GameNode]:
+        """
+        The nearest ancestor of a leaf whose outcome estimate has converged.
+        The upstream branchable nodes of a leaf have a single rollout each,
+        so it is the subtrees the leaf belongs to that tell whether
+        branching from it is worth more rollouts.
+        """
+        if self.ci_width is None:
+            return None
+        curr = node.parent
+        while curr is not None:
+            if self.converged(curr):
+                return curr
+            curr = curr.parent
+        return None
+
+    def expand_branching_points(self, leaf: GameNode):
+        """
+        Sample branching points from a finished leaf,
+        expand them and add the new nodes to the sample queue.
+        If the budget is exhausted, the leaf is left pending.
+        """
+        if self.budget_exhausted():
+            with self.lock:
+                self.pending.append(leaf.id)
+            return
+        # step 3. Sample branching points from the leaf node.
+        branching_points = self.sample_branching_points(leaf)
+        for branching_point in branching_points:
+            # step 4. Expand the branching points to create new nodes.
+            to_be_played = branching_point.expand()
+            # step 5. Add the new nodes to the sample queue.
+            self.push_frontier(to_be_played)
+        leaf.settled = True
+        leaf.update_data()
+
+    def record_rollout(
+            self,
+            leaf: GameNode,
+            outcome: Union[dict, GameNode]
+    ):
+        """
+        Record the outcome of a finished rollout in its leaf and ancestors:
+        the result of the game, or that of the equivalent node
+        the rollout was transposed to.
+        Concurrent rollouts are recorded in the order their nodes were taken
+        from the sample queue, not as they finish, so the sampling strategy
+        and the transpositions only see the results of the rollouts before.
+        """
+        if isinstance(outcome, GameNode):
+            leaf.transpose(outcome)
+        else:
+            leaf.record_result(outcome)
+        self.register_rollout(leaf)
+
+    def start_run(self):
+        """
+        Start the clock of the budget for a run.
+        A run stopped by the budget may be continued once it is raised,
+        starting with the leaves it left unexpanded.
+        """
+        self.stopped = None
+        self.budget.start()
+        for leaf in list(self.nodes.values()):
+            if leaf.is_terminal and not leaf.settled:
+                self.expand_branching_points(leaf)
+
+    def budget_exhausted(self) -> bool:
+        """
+        Check the budget of the sampler.
+        Once the budget is exhausted, no more rollouts or expansions are started.
+        """
+        if self.stopped is None:
+            self.stopped = self.budget.exhausted()
+        # replayed calls cost nothing, a replay ends with its recording
+        if self.stopped is None and self.replay is not None \
+                and not self.replay.remaining:
+            self.stopped = "replay"
+        return self.stopped is not None
+
     def sample_trajectories(self):
         """
         Sample game trajectories.
+        If the sampler has more than one worker,
+        or its workers are processes or coroutines,
+        the trajectories are rolled out concurrently.
         """
+        if self.worker_type == "async":
+            asyncio.run(self.sample_trajectories_async())
+            return
+        self.start_run()
+        if self.worker_type == "process":
+            self.sample_trajectories_process()
+            return
+        if self.num_workers > 1:
+            self.sample_trajectories_concurrent()
+            return
+
         # The sampling process is as follows:
-        # Repeat steps 1-5 until the sample queue is empty.
-        while self.sample_queue:
+        # Repeat steps 1-5 until the sample queue is empty,
+        # or the budget is exhausted.
+        while self.frontier and not self.budget_exhausted():
             # step 1. Take a node from the sample queue.
-            curr = self.sample_queue.pop()
+            curr = self.pop_frontier()
             # step 2. Roll out the game from the node to the end.
-            leaf = curr.roll_out()
-            # step 3. Sample branching points from the leaf node.
-            branching_points = self.sample_branching_points(leaf)
-            for branching_point in branching_points:
-                # step 4. Expand the branching points to create new nodes.
-                to_be_played = branching_point.expand()
-                # step 5. Add the new nodes to the sample queue.
-                self.sample_queue.extendleft(to_be_played)
+            leaf, outcome = curr.roll_out()
+            self.record_rollout(leaf, outcome)
+            # step 3-5. Expand the branching points of the leaf.
+            self.expand_branching_points(leaf)
+            self.save()
+            logger.info("Saved game sampler.")
+        self.finish()
+
+    def sample_trajectories_concurrent(self):
+        """
+        Sample game trajectories with a pool of rollout workers.
+        Rollouts run in parallel, but finished rollouts are recorded
+        and expanded in the order their nodes were taken from the sample queue.
+        New nodes are added to the other end of the queue,
+        so nodes are taken in the same order as in a serial run,
+        and branching points are selected from the same results.
+        The tree differs from the one a serial run would build
+        when a rollout could be transposed to the state of a rollout
+        still in flight, and when a budget is exhausted,
+        since the rollouts in flight then are finished.
+        """
+        in_flight: Deque[Future] = deque()
+        with ThreadPoolExecutor(
+            max_workers=self.num_workers,
+            thread_name_prefix="rollout"
+        ) as executor:
+            # Once the budget is exhausted, the rollouts in flight are finished.
+            while in_flight or (self.frontier and not self.budget_exhausted()):
+                # step 1-2. Keep the workers busy with nodes from the queue.
+                while self.frontier and len(in_flight) < self.num_workers \
+                        and not self.budget_exhausted():
+                    curr = self.pop_frontier()
+                    in_flight.append(
+                        executor.submit(curr.roll_out, self.recorded))
+                if not in_flight:
+                    break
+                # step 3-5. Expand the oldest rollout once it is finished.
+                leaf, outcome = in_flight.popleft().result()
+                self.record_rollout(leaf, outcome)
+                self.expand_branching_points(leaf)
+                self.save()
+                logger.info("Saved game sampler.")
+        self.finish()
+
+    async def sample_trajectories_async(self):
+        """
+        Sample game trajectories on the running event loop,
+        with up to num_workers rollouts in flight,
+        so a single thread waits for the LLM calls of many games at once.
+        As with threads, finished rollouts are expanded
+        in the order their nodes were taken from the sample queue.
+        """
+        self.start_run()
+        in_flight: Deque[asyncio.Task] = deque()
+        while in_flight or (self.frontier and not self.budget_exhausted()):
+            # step 1-2. Keep the loop busy with nodes from the queue.
+            while self.frontier and len(in_flight) < self.num_workers \
+                    and not self.budget_exhausted():
+                curr = self.pop_frontier()
+                in_flight.append(asyncio.create_task(
+                    curr.roll_out_async(self.recorded)))
+            if not in_flight:
+                break
+            # step 3-5. Expand the oldest rollout once it is finished.
+            leaf, outcome = await in_flight.popleft()
+            self.record_rollout(leaf, outcome)
+            self.expand_branching_points(leaf)
             self.save()
             logger.info("Saved game sampler.")
-        logger.success("Sampling finished.")
+        self.finish()
+
+    def sample_trajectories_process(self):
+        """
+        Sample game trajectories with a pool of rollout worker processes,
+        so unpickling games and building prompts is not bound by the GIL.
+        A worker is sent the record of a node from the sample queue,
+        plays the game from the snapshot of the node to the end,
+        and returns the records of the nodes of the rollout,
+        which are merged into the tree here.
+        As with threads, finished rollouts are merged and expanded
+        in the order their nodes were taken from the sample queue.
+        """
+        from .worker import init_worker, roll_out_in_worker
+
+        in_flight: Deque[Future] = deque()
+        with ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            initializer=init_worker,
+            initargs=(self.config,)
+        ) as executor:
+            while in_flight or (self.frontier and not self.budget_exhausted()):
+                # step 1-2. Keep the workers busy with nodes from the queue.
+                while self.frontier and len(in_flight) < self.num_workers \
+                        and not self.budget_exhausted():
+                    curr = self.pop_frontier()
+                    in_flight.append(executor.submit(
+                        roll_out_in_worker, self.rollout_task(curr)))
+                if not in_flight:
+                    break
+                # step 3-5. Merge and expand the oldest rollout.
+                rollout = in_flight.popleft().result()
+                self.tracer.extend(rollout["trace"])
+                leaf = self.merge_rollout(rollout)
+                self.expand_branching_points(leaf)
+                self.save()
+                logger.info("Saved game sampler.")
+        self.finish()
+
+    def rollout_task(self, node: GameNode) -> dict:
+        """
+        The task of rolling out a node in a worker process.
+        The worker reads and rewrites the snapshots of the node and its parent,
+        so they are written out and dropped from memory first.
+        """
+        parent = node.parent
+        with self.lock:
+            self.snapshots.invalidate(node.id)
+            task = {
+                "id": node.id,
+                "data": node.data,
+                "game_status": node.game_status,
+                "branch_status": node.branch_status,
+                "settled": node.settled,
+                "parent": None,
+            }
+            if parent is not None:
+                self.snapshots.invalidate(parent.id)
+                task["parent"] = {
+                    "id": parent.id,
+                    "data": parent.data,
+                    "level": parent.level,
+                    "depth": parent.depth,
+                    "branch_status": parent.branch_status,
+                }
+            return task
+
+    def merge_rollout(self, rollout: dict) -> GameNode:
+        """
+        Merge the nodes of a rollout played in a worker process into the tree,
+        and backpropagate the result of its leaf.
+        Returns the leaf.
+        """
+        with self.lock:
+            self.budget.add(rollout["usage"])
+            for node_id in rollout["removed"]:
+                node = self.nodes[node_id]
+                node.parent.remove_child(node)
+                self.remove_node(node)
+            for record in rollout["records"]:
+                node_id = record["id"]
+                if node_id in self.nodes:
+                    node = self.nodes[node_id]
+                    node.data = record["data"]
+                    node.game_status = record["game_status"]
+                    node.branch_status = record["branch_status"]
+                    node.settled = record["settled"]
+                else:
+                    node = reconstruct_game_node(
+                        node_id, record, self, "sample")
+                node.update_data()
+
+            leaf = self.nodes[rollout["leaf"]]
+            result = leaf.data["result"]
+            # A concurrent step rewrites the game of the parent,
+            # but only the nodes of the rollout have their results
+            # recorded by the worker.
+            if rollout["parent"] is not None:
+                parent = self.nodes[rollout["parent"]["id"]]
+                parent_data = rollout["parent"]["data"]
+                parent.data["observable_state"] = \
+                    parent_data["observable_state"]
+                if self.transposition:
+                    self.index_fingerprint(
+                        parent, parent_data.get("fingerprint"))
+                self.snapshots.invalidate(parent.id)
+                # the top node of the rollout holds its metrics
+                top = next(
+                    record for record in rollout["records"]
+                    if record["parent_id"] == parent.id)
+                parent.add_result(
+                    result, top["data"].get("subtree_metrics", {}))
+            self.register_rollout(leaf)
+        logger.info(f"Recorded result: {result}")
+        return leaf
+
+    def finish(self):
+        """
+        Called at the end of a sampling run.
+        In journal mode, the archive and the table are exported only here.
+        The trace of the run, if any, is saved here as well.
+        The snapshot store, the thread pool of the subprocess executor
+        and the log files are closed, to be opened again when used next.
+        """
+        self.budget.stop()
+        self.snapshots.close()
+        self.executor.shutdown()
+        if self.persistence == "journal":
+            self.export()
+        self.save_frontier()
+        if self.tracer.enabled:
+            self.tracer.save(os.path.join(self.data_dir, 'trace.json'))
+        if self.stopped is not None:
+            logger.warning(
+                f"Sampling stopped: {self.stopped} exhausted, "
+                f"usage: {self.budget.usage}")
+        else:
+            logger.success("Sampling finished.")
+        remove_log_sinks(self.data_dir)
+
+    def remove_subtree(self, node: GameNode):
+        """
+        Remove a node and all its descendants, with their snapshots.
+        """
+        with self.lock:
+            if node.parent is not None:
+                node.parent.remove_child(node)
+            stack = [node]
+            while stack:
+                curr = stack.pop()
+                stack.extend(curr.children)
+                self.remove_node(curr)
+                self.snapshots.remove(curr.id)
+
+    def resume(self, frontier: dict):
+        """
+        Restore the sample queue of a reconstructed sampler,
+        given the frontier saved by the run.
+        Rollouts cut short are reclaimed from their snapshots:
+        - nodes whose snapshot was lost are removed, with their subtrees;
+        - unplayed tips are queued again;
+        - played tips are continued with a new child,
+          except the nodes of a concurrent step whose fan-out was not
+          finished, which are played again from their parent;
+        - nodes cut short while branching are expanded again.
+        The results are recomputed from the finished leaves,
+        and the leaves whose branching points were not sampled are expanded.
+        """
+        with self.lock:
+            self.budget.restore(frontier.get("usage", {}))
+            self.sample_queue.clear()
+            self.frontier.clear()
+            self.pending = []
+
+            # step 1. Remove the nodes whose snapshot was lost.
+            for node in list(self.nodes.values()):
+                if node.id in self.nodes \
+                        and not self.snapshots.exists(node.id):
+                    assert not node.is_root, "the root snapshot is lost"
+                    logger.warning(f"Snapshot of {node} is lost, removed.")
+                    self.remove_subtree(node)
+
+            # step 2. Remove the concurrent steps whose fan-out was not finished.
+            # A node of a concurrent step is marked until the fan-out,
+            # created next to it, replaces it.
+            # The nodes are in the order they were first recorded,
+            # so its siblings recorded after it belong to the fan-out.
+            order = {node_id: i for i, node_id in enumerate(self.nodes)}
+            reclaimed = []
+            for node in list(self.nodes.values()):
+                if node.id not in self.nodes or node.is_root \
+                        or not node.fan_out:
+                    continue
+                parent = node.parent
+                for sibling in list(parent.children):
+                    if order[sibling.id] >= order[node.id]:
+                        self.remove_subtree(sibling)
+                reclaimed.append(parent.create_child())
+            leaves = [
+                node for node in self.nodes.values() if not node.children]
+
+            # step 3. Recompute the results from the finished leaves,
+            # and the shares of the transposed leaves.
+            results = {node.id: {} for node in self.nodes.values()}
+            transposed = {node.id: {} for node in self.nodes.values()}
+            stats = {node.id: new_stats() for node in self.nodes.values()}
+            for leaf in leaves:
+                if not leaf.is_terminal:
+                    continue
+                if "transposition" in leaf.data:
+                    result = leaf.data.get("transposed", {})
+                    totals = transposed
+                else:
+                    result = leaf.data["result"]
+                    totals = results
+                if not result and leaf.game_status == FINISHED:
+                    leaf.load_game()
+                    result = dict(leaf.game.result)
+                    leaf.offload_game(persist=False)
+                curr = leaf
+                while curr is not None:
+                    result_dict = totals[curr.id]
+                    for k, v in result.items():
+                        result_dict[k] = result_dict.get(k, 0) + v
+                    update_stats(stats[curr.id], result)
+                    curr = curr.parent
+            # The metrics are rolled up from the nodes played,
+            # children before their parents.
+            subtree_metrics = {}
+            for node in sorted(
+                    self.nodes.values(), key=lambda x: x.level, reverse=True):
+                if node.game_status == UNPLAYED:
+                    continue
+                total = dict(node.data.get("metrics", {}))
+                for child in node.children:
+                    add_metrics(total, subtree_metrics.get(child.id, {}))
+                subtree_metrics[node.id] = total
+            for node in self.nodes.values():
+                if node.data["result"] != results[node.id] \
+                        or node.data.get("transposed", {}) \
+                        != transposed[node.id] \
+                        or node.data.get("stats") != stats[node.id] \
+                        or node.data.get("subtree_metrics") \
+                        != subtree_metrics.get(node.id):
+                    node.data["result"] = results[node.id]
+                    node.data.pop("transposed", None)
+                    if transposed[node.id]:
+                        node.data["transposed"] = transposed[node.id]
+                    node.data["stats"] = stats[node.id]
+                    node.data.pop("subtree_metrics", None)
+                    if node.id in subtree_metrics:
+                        node.data["subtree_metrics"] = subtree_metrics[node.id]
+                    node.update_data()
+
+            # step 4. Reclaim the rollouts cut short.
+            for tip in leaves:
+                if tip.game_status == PLAYED and not tip.is_terminal \
+                        and tip not in reclaimed:
+                    reclaimed.append(tip.create_child())
+            for node in list(self.nodes.values()):
+                if node.branch_status == BRANCHED:
+                    cut_short = len(node.children) < self.max_degree
+                else:
+                    cut_short = len(node.children) > 1
+                if cut_short:
+                    reclaimed.extend(node.expand())
+
+            # The reclaimed rollouts were taken before the queued nodes.
+            unplayed = [
+                tip.id for tip in leaves
+                if tip.game_status == UNPLAYED and tip not in reclaimed
+            ]
+            queue = [
+                node_id for node_id in frontier.get("queue", [])
+                if node_id in unplayed
+            ]
+            queue += [node_id for node_id in unplayed if node_id not in queue]
+            self.push_frontier(reclaimed + [self.nodes[x] for x in queue])
+
+        # step 5. Expand the finished leaves that were not settled.
+        for leaf in leaves:
+            if leaf.is_terminal and not leaf.settled:
+                self.expand_branching_points(leaf)
+        self.save()
+        logger.info(
+            f"Resumed game sampler with {len(self.frontier)} nodes queued.")
+
+    def save_frontier(self):
+        """
+        Save the nodes waiting in the sample queue, in the order they are taken,
+        and the leaves whose branching points are not expanded yet.
+        """
+        with self.lock:
+            frontier = {
+                "queue": [
+                    node.id for node in reversed(self.sample_queue)
+                    if node.id in self.frontier
+                ],
+                "pending": list(self.pending),
+                "stopped": self.stopped,
+                "usage": self.budget.usage,
+            }
+        save_json(frontier, os.path.join(self.data_dir, 'frontier.json'))
 
     def save(self):
         """
-        Save the game sampler to a file.
+        Save the game sampler.
+        In full mode, the whole sampler is exported after every call.
+        In journal mode, node records are appended to the journal as they
+        are updated, so saving only flushes the journal to disk.
+        The sample queue is saved to frontier.json, so the run can be resumed.
+        """
+        self.snapshots.flush()
+        if self.persistence == "journal":
+            with self.lock:
+                self.journal.flush()
+        else:
+            self.export()
+        self.save_frontier()
+
+    def export(self):
+        """
+        Export the game sampler to files.
         The game sampler is saved to a directory with the following structure:
         ├── data
         │   ├── game_name
@@ -494,99 +1597,181 @@ class GameSampler:
         │   │   │   ├── config.json
         │   │   │   ├── archive.json
         │   │   │   ├── data.csv
-        │   │   │   ├── game
+        │   │   │   ├── frontier.json (written by save)
+        │   │   │   ├── journal.jsonl (journal mode only)
+        │   │   │   ├── .game (snapshot store)
         │   │   │   │   ├── node_id.pkl
         │   │   │   │   ├── ...
         """
-        save_pickle(self, os.path.join(self.data_dir, "sampler.pkl"))
-        save_json(self.data, os.path.join(self.data_dir, 'archive.json'))
-        df = pd.DataFrame(self.data).T
+        with self.lock:
+            if self.journal is not None:
+                self.journal.flush()
+            save_pickle(self, os.path.join(self.data_dir, "sampler.pkl"))
+            archive = dict(self.data)
+            save_json(archive, os.path.join(self.data_dir, 'archive.json'))
+            df = pd.DataFrame(archive).T
+        # metrics get a column each in the table
+        for key in ["metrics", "subtree_metrics"]:
+            if key in df:
+                metrics = pd.DataFrame(
+                    [x if isinstance(x, dict) else {} for x in df[key]],
+                    index=df.index
+                ).add_prefix(f"{key}.")
+                df = df.drop(columns=key).join(metrics)
         df.to_csv(os.path.join(self.data_dir, 'data.csv'))
 
 
 def reconstruct_game_node(
         node_id: str,
-        archive: dict,
+        record: dict,
         sampler: GameSampler,
-        mode: str
+        mode: str,
+        detail_source: Optional[Tuple[str, Tuple[int, int]]] = None
 ) -> GameNode:
     """
-    Reconstruct a game node from the archive.
-    If the node is already in the sampler, return it.
-    Otherwise, create a new node and add it to the sampler.
+    Reconstruct a game node from its record in the archive.
+    The parent of the node should be reconstructed already.
+    If the detail of the record is not loaded,
+    detail_source locates the record to load it from on demand.
     """
-    # Check if the node is already in the sampler
-    # If it is, do nothing
-    if node_id in sampler.nodes:
-        return
+    parent_id = record["parent_id"]
+    parent = sampler.nodes[parent_id] if parent_id is not None else None
 
-    # Otherwise, create a new node and add it to the sampler
     node = GameNode(
         sampler=sampler,
-        mode=mode
+        parent=parent,
+        mode=mode,
+        node_id=node_id
     )
-    node.id = node_id
-    value = archive[node_id]
-    data = value["data"]
+    data = record["data"]
     if mode == "sample":
         node.data = data
+        # statuses are interned, not kept as a string per node
+        node.game_status = sys.intern(record.get("game_status", UNPLAYED))
+        node.branch_status = sys.intern(
+            record.get("branch_status", BRANCHABLE))
+        # archives without the flag predate it, their leaves were settled
+        node.settled = record.get("settled", True)
+        node.fan_out = record.get("fan_out", False)
+        if sampler.transposition:
+            sampler.register_fingerprint(node)
     elif mode == "display":
         node.display["result"] = data["result"]
         node.display["observable_state"] = data["observable_state"]
-        assert len(data["detail"]) <= 1
-        if data["detail"]:
-            node.display.update(data["detail"][-1])
-
-    sampler.nodes[node_id] = node
-
-    # Set the parent of the node
-    parent_id = value["parent_id"]
+        if detail_source is not None:
+            node.detail_source = detail_source
+        else:
+            node.display_detail(data["detail"])
 
-    if parent_id is None:
+    if parent is None:
         # If the parent is None, the node is the root
         sampler.root = node
-
-    elif parent_id in sampler.nodes:
-        # If the parent is already in the sampler,
-        # set the parent of the node to the parent in the sampler
-        parent = sampler.nodes[parent_id]
-        node.parent = parent
-        parent.children.append(node)
-
-    else:
-        # Otherwise, reconstruct the parent node
-        # and set the parent of the node to it
-        parent = reconstruct_game_node(
-            node_id=parent_id,
-            archive=archive,
-            sampler=sampler,
-            mode=mode
-        )
-        node.parent = parent
-        parent.children.append(node)
     return node
 
 
 def reconstruct_game_sampler(
-        archive: dict,
+        archive: Union[dict, Iterable[ArchiveItem]],
         config: dict,
         mode: str = "sample"
 ) -> GameSampler:
     """
     Reconstruct a game sampler from the archive.
+    The archive is either a dictionary of records by node id,
+    or a stream of records as given by stream_archive.
+    The nodes are reconstructed iteratively in topological order:
+    a node whose parent has not been reconstructed yet
+    waits until the parent is.
     """
     assert mode in ["sample", "display"]
-    sampler = GameSampler(
-        name=config["name"],
-        max_depth=config["max_depth"],
-        max_degree=config["max_degree"],
-        sample_id=config["sample_id"]
-    )
-    for node_id in archive.keys():
-        reconstruct_game_node(node_id, archive, sampler, mode)
+    sampler = GameSampler.from_config(config)
+    if isinstance(archive, dict):
+        archive = (
+            (node_id, record, None) for node_id, record in archive.items())
+
+    # items waiting for their parent, by parent id
+    waiting: Dict[str, List[ArchiveItem]] = {}
+    for item in archive:
+        node_id, record, _ = item
+        if node_id in sampler.nodes:
+            continue
+        parent_id = record["parent_id"]
+        if parent_id is not None and parent_id not in sampler.nodes:
+            waiting.setdefault(parent_id, []).append(item)
+            continue
+        stack = [item]
+        while stack:
+            node_id, record, detail_source = stack.pop()
+            reconstruct_game_node(
+                node_id, record, sampler, mode, detail_source)
+            stack.extend(reversed(waiting.pop(node_id, [])))
+
+    if waiting:
+        orphans = sum(len(items) for items in waiting.values())
+        logger.warning(
+            f"{orphans} nodes whose parent is not in the archive are skipped.")
     return sampler
 
 
+def stream_archive(
+        path: str,
+        lazy_detail: bool = False
+) -> Iterator[ArchiveItem]:
+    """
+    Stream the archive of a game sampler from its directory,
+    without loading the whole archive file into memory.
+    The journal is preferred if there is one,
+    since it is never older than the exported archive.
+    Yields the node id, the record and the source of the detail.
+    If lazy_detail is True, the detail is dropped from the record,
+    and the source locates the record in the file to load it from,
+    otherwise the source is None.
+    """
+    journal_path = os.path.join(path, 'journal.jsonl')
+    if os.path.exists(journal_path):
+        # The records are merged from the lines of a node,
+        # so the journal is replayed first.
+        # The detail of a node is on the last line of the node holding it.
+        records, spans = {}, {}
+        for line, span in iter_journal(journal_path):
+            if "detail" in line.get("data", {}):
+                spans[line["id"]] = span
+                if lazy_detail:
+                    drop_detail(line)
+            apply_line(records, line)
+        source_path = journal_path
+        # the fields of the data are repeated as in the exported archive
+        items = ((node_id, dict(record, **record["data"]), spans.get(node_id))
+                 for node_id, record in records.items())
+    else:
+        source_path = os.path.join(path, 'archive.json')
+        items = iter_json_object(source_path)
+
+    for node_id, record, span in items:
+        if lazy_detail:
+            drop_detail(record)
+            yield node_id, record, (source_path, span)
+        else:
+            yield node_id, record, None
+
+
+def drop_detail(record: dict):
+    """
+    Drop the detail from a node record.
+    """
+    record.pop("detail", None)
+    record["data"].pop("detail", None)
+
+
+def load_archive(path: str) -> dict:
+    """
+    Load the archive of a game sampler from its directory.
+    The journal is preferred if there is one,
+    since it is never older than the exported archive.
+    """
+    return {
+        node_id: record for node_id, record, _ in stream_archive(path)}
+
+
 def reconstruct_game_sampler_for_sampling(path: str) -> GameSampler:
     """
     Reconstruct a game sampler given the game name and id.
@@ -594,8 +1779,72 @@ def reconstruct_game_sampler_for_sampling(path: str) -> GameSampler:
     The game directory should contain the archive and config files.
     """
     config = read_json(os.path.join(path, 'config.json'))
-    archive = read_json(os.path.join(path, 'archive.json'))
+    archive = stream_archive(path)
+    sampler = reconstruct_game_sampler(archive, config)
+    return sampler
+
+
+def resume_game_sampler(path: str, **kwargs) -> GameSampler:
+    """
+    Resume a sampling run from its directory,
+    after a crash or after its budget was exhausted.
+    The tree is rebuilt from the archive and the snapshots,
+    and the sample queue from the frontier saved by the run,
+    so no LLM call that was saved is made again.
+    Keyword arguments override the config, e.g. to raise the budget.
+    Call sample_trajectories on the returned sampler to continue sampling.
+    """
+    config = read_json(os.path.join(path, 'config.json'))
+    config.update(kwargs)
+    archive = stream_archive(path)
     sampler = reconstruct_game_sampler(archive, config)
+    frontier_path = os.path.join(path, 'frontier.json')
+    frontier = {}
+    if os.path.exists(frontier_path):
+        frontier = read_json(frontier_path)
+    sampler.resume(frontier)
+    return sampler
+
+
+def replay_game_sampler(path: str, **kwargs) -> GameSampler:
+    """
+    Replay a sampling run from its directory without calling the API.
+    A new sampler plays the game again from the game the run started from,
+    and the players are served the LLM outputs recorded in the archive.
+    With the same sampling choices, e.g. the same random seed,
+    the tree of the run is rebuilt.
+    Keyword arguments override the config, e.g. the number of workers.
+    Process workers cannot share the recorded outputs,
+    so their rollouts run on threads instead.
+    Call sample_trajectories on the returned sampler to replay the run.
+    """
+    config = read_json(os.path.join(path, 'config.json'))
+    config.update(kwargs)
+    if config.get("worker_type") == "process":
+        config["worker_type"] = "thread"
+    root_id, root_detail, details = None, [], []
+    for node_id, record, _ in stream_archive(path):
+        if record["parent_id"] is None:
+            root_id, root_detail = node_id, record["data"]["detail"]
+        else:
+            details.append(record["data"]["detail"])
+    snapshots = create_snapshot_store(
+        os.path.join(path, ".game"), config.get("snapshot_store", "pickle"))
+    if snapshots.exists(initial_snapshot_id(root_id)):
+        # the root is played again as well
+        game = snapshots.load(initial_snapshot_id(root_id))
+        details.insert(0, root_detail)
+        root_detail = []
+    else:
+        # runs recorded without the game they started from are replayed
+        # from the snapshot of the root, as it was after it was played
+        game = snapshots.load(root_id)
+    snapshots.close()
+    replay = Replay()
+    for detail in details:
+        replay.add(detail)
+    sampler = GameSampler.from_config(config, game=game, replay=replay)
+    sampler.root.data["detail"] = root_detail
     return sampler
 
 
@@ -606,6 +1855,6 @@ def reconstruct_game_sampler_for_display(path: str) -> GameSampler:
     The game directory should contain the archive and config files.
     """
     config = read_json(os.path.join(path, 'config.json'))
-    archive = read_json(os.path.join(path, 'archive.json'))
+    archive = stream_archive(path, lazy_detail=True)
     sampler = reconstruct_game_sampler(archive, config, mode="display")
     return sampler
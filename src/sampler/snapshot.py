@@ -0,0 +1,713 @@
+import atexit
+import hashlib
+import lzma
+import os
+import pickle
+import queue
+import threading
+import zlib
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from game import Game
+from utils.path_manager import validate_dir
+from utils.tracer import Tracer, get_default_tracer
+
+
+SNAPSHOT_PROTOCOL = 5
+COMPRESSIONS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+LZMA_MAGIC = b"\xfd7zXZ\x00"
+
+
+def dump_game(game: Game, compression: Optional[str] = None) -> bytes:
+    """
+    Serialize a game with pickle protocol 5,
+    optionally compressed with zlib or lzma.
+    """
+    data = pickle.dumps(game, protocol=SNAPSHOT_PROTOCOL)
+    if compression is not None:
+        data = COMPRESSIONS[compression][0](data)
+    return data
+
+
+def load_game(data: bytes) -> Game:
+    """
+    Deserialize a game, telling the compression from the leading bytes,
+    so snapshots of any format are read.
+    """
+    if data.startswith(LZMA_MAGIC):
+        data = lzma.decompress(data)
+    elif not data.startswith(pickle.PROTO):
+        data = zlib.decompress(data)
+    return pickle.loads(data)
+
+
+class SnapshotStore:
+    """
+    A store of game snapshots, keyed by node id.
+    Subclasses decide how the serialized snapshots are kept on disk,
+    by implementing write, read, exists and remove.
+    """
+
+    def __init__(self, directory: str, compression: Optional[str] = None):
+        assert compression is None or compression in COMPRESSIONS, \
+            f"Unknown compression: {compression}"
+        self.directory = validate_dir(directory)
+        self.compression = compression
+        self.tracer = get_default_tracer()
+
+    def dumps(self, game: Game) -> bytes:
+        """
+        Serialize a game.
+        """
+        with self.tracer.span("dumps", "pickle") as span:
+            data = dump_game(game, self.compression)
+            if span is not None:
+                span["bytes"] = len(data)
+        return data
+
+    def loads(self, data: bytes) -> Game:
+        """
+        Deserialize a game.
+        """
+        with self.tracer.span("loads", "pickle", bytes=len(data)):
+            return load_game(data)
+
+    def write(self, node_id: str, data: bytes):
+        raise NotImplementedError(
+            f"{self.__class__.__name__} should implement write method")
+
+    def read(self, node_id: str) -> bytes:
+        raise NotImplementedError(
+            f"{self.__class__.__name__} should implement read method")
+
+    def exists(self, node_id: str) -> bool:
+        raise NotImplementedError(
+            f"{self.__class__.__name__} should implement exists method")
+
+    def remove(self, node_id: str):
+        raise NotImplementedError(
+            f"{self.__class__.__name__} should implement remove method")
+
+    def save(self, node_id: str, game: Game, persist: bool = True):
+        """
+        Save the snapshot of a game for the node.
+        If persist is False, the caller guarantees the node already has
+        the same snapshot on disk, e.g. right after a link.
+        """
+        if persist:
+            self.write(node_id, self.dumps(game))
+
+    def load(self, node_id: str) -> Game:
+        """
+        Load the snapshot of the node.
+        """
+        return self.loads(self.read(node_id))
+
+    def link(self, src_id: str, dst_id: str):
+        """
+        Give the destination node the same snapshot as the source node.
+        """
+        self.write(dst_id, self.read(src_id))
+
+    def invalidate(self, node_id: str):
+        """
+        Forget what is kept in memory about the snapshot of a node,
+        because another process is about to rewrite it.
+        Pending writes of the node are finished first.
+        """
+
+    def sync(self, node_ids: Iterable[str]):
+        """
+        Make sure the snapshots of the given nodes are on disk.
+        """
+        self.flush()
+
+    def flush(self):
+        """
+        Make sure every saved snapshot is on disk.
+        """
+
+    def close(self):
+        """
+        Release the resources held by the store.
+        """
+
+
+def write_atomic(path: str, data: bytes):
+    """
+    Write a file through a temporary file,
+    so a crash never leaves it half written.
+    """
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class PickleSnapshotStore(SnapshotStore):
+    """
+    Stores every snapshot as a full pickle file named after the node id.
+    """
+
+    def path(self, node_id: str) -> str:
+        return os.path.join(self.directory, f"{node_id}.pkl")
+
+    def write(self, node_id: str, data: bytes):
+        write_atomic(self.path(node_id), data)
+
+    def read(self, node_id: str) -> bytes:
+        with open(self.path(node_id), 'rb') as f:
+            return f.read()
+
+    def exists(self, node_id: str) -> bool:
+        return os.path.exists(self.path(node_id))
+
+    def remove(self, node_id: str):
+        if self.exists(node_id):
+            os.remove(self.path(node_id))
+
+    def sync(self, node_ids: Iterable[str]):
+        for node_id in node_ids:
+            if self.exists(node_id):
+                with open(self.path(node_id), 'rb') as f:
+                    os.fsync(f.fileno())
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# content-defined chunking parameters
+CHUNK_WINDOW = 48
+CHUNK_MASK = (1 << 11) - 1  # 2KB average chunk size
+CHUNK_MIN_SIZE = 512
+CHUNK_MAX_SIZE = 16384
+GEAR = np.random.default_rng(0).integers(
+    0, 1 << 63, size=256, dtype=np.uint64)
+
+
+def chunk_boundaries(data: bytes) -> List[int]:
+    """
+    Split data into content-defined chunks, and return the end offsets.
+    A chunk ends where the hash of the last CHUNK_WINDOW bytes matches
+    CHUNK_MASK, so an insertion in the data only changes nearby chunks.
+    """
+    size = len(data)
+    if size <= CHUNK_MIN_SIZE:
+        return [size]
+    gear = GEAR[np.frombuffer(data, dtype=np.uint8)]
+    # the rolling hash is a sum over a window, computed with a prefix sum
+    prefix = np.cumsum(gear, dtype=np.uint64)
+    window = prefix[CHUNK_WINDOW:] - prefix[:-CHUNK_WINDOW]
+    candidates = np.nonzero((window & CHUNK_MASK) == 0)[0] + CHUNK_WINDOW + 1
+
+    result = []
+    start = 0
+    for end in candidates.tolist() + [size]:
+        while end - start > CHUNK_MAX_SIZE:
+            start += CHUNK_MAX_SIZE
+            result.append(start)
+        if end - start >= CHUNK_MIN_SIZE or (end == size and end > start):
+            result.append(end)
+            start = end
+    return result
+
+
+class ChunkedSnapshotStore(SnapshotStore):
+    """
+    Splits snapshots into content-defined chunks, and stores every distinct
+    chunk once, compressed, in an append-only pack file.
+    A node only keeps a manifest listing the hashes of its chunks.
+    Identical snapshots share all their chunks,
+    and a child shares with its parent every chunk that did not change,
+    so a child effectively costs the delta against its parent.
+
+    Every writer process appends to a pack of its own,
+    and reads the chunks of all packs.
+    The store has the following structure:
+    ├── .game
+    │   ├── chunks.pack (compressed chunks)
+    │   ├── chunks.idx (chunk hash, offset and length in the pack)
+    │   ├── chunks-writer.pack (chunks of a worker process)
+    │   ├── chunks-writer.idx
+    │   ├── node_id.snap (manifest of a node)
+    │   ├── ...
+
+    Chunks of removed nodes are not reclaimed.
+    """
+
+    def __init__(self, directory: str, writer: Optional[str] = None):
+        super().__init__(directory)
+        self.lock = threading.Lock()
+        # chunk hash to the pack, offset and length of the chunk
+        self.index: Dict[str, Tuple[str, int, int]] = {}
+        # bytes of the index file of each pack read so far
+        self.index_read: Dict[str, int] = {}
+        self.pack = "chunks" if writer is None else f"chunks-{writer}"
+        self.pack_writer = None
+        self.index_writer = None
+        self.pack_readers: Dict[str, BinaryIO] = {}
+        self.read_index()
+
+    def pack_path(self, pack: str) -> str:
+        return os.path.join(self.directory, f"{pack}.pack")
+
+    def index_path(self, pack: str) -> str:
+        return os.path.join(self.directory, f"{pack}.idx")
+
+    def read_index(self):
+        """
+        Read the index files of all packs, from where they were read last.
+        """
+        for name in os.listdir(self.directory):
+            if not name.endswith(".idx"):
+                continue
+            pack = name[:-len(".idx")]
+            start = self.index_read.get(pack, 0)
+            with open(self.index_path(pack), 'rb') as f:
+                f.seek(start)
+                data = f.read()
+            # a truncated last line is ignored, until it is complete
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].decode().splitlines():
+                fields = line.split()
+                if len(fields) == 3:
+                    digest, offset, length = fields
+                    self.index[digest] = (pack, int(offset), int(length))
+            self.index_read[pack] = start + end
+
+    def path(self, node_id: str) -> str:
+        return os.path.join(self.directory, f"{node_id}.snap")
+
+    def open(self):
+        if self.pack_writer is None:
+            self.pack_writer = open(self.pack_path(self.pack), 'ab')
+            self.index_writer = open(self.index_path(self.pack), 'a')
+
+    def write_chunk(self, chunk: bytes) -> str:
+        digest = hashlib.blake2b(chunk, digest_size=16).hexdigest()
+        if digest not in self.index:
+            compressed = zlib.compress(chunk)
+            offset = self.pack_writer.seek(0, os.SEEK_END)
+            self.pack_writer.write(compressed)
+            self.index[digest] = (self.pack, offset, len(compressed))
+            self.index_writer.write(f"{digest} {offset} {len(compressed)}\n")
+        return digest
+
+    def read_chunk(self, digest: str) -> bytes:
+        if digest not in self.index:
+            # the chunk was written by another process
+            self.read_index()
+        pack, offset, length = self.index[digest]
+        reader = self.pack_readers.get(pack)
+        if reader is None:
+            reader = open(self.pack_path(pack), 'rb')
+            self.pack_readers[pack] = reader
+        reader.seek(offset)
+        return zlib.decompress(reader.read(length))
+
+    def write(self, node_id: str, data: bytes):
+        with self.lock:
+            self.open()
+            digests = []
+            start = 0
+            for end in chunk_boundaries(data):
+                digests.append(self.write_chunk(data[start:end]))
+                start = end
+            # chunks must be on disk before the manifest refers to them
+            self.pack_writer.flush()
+            self.index_writer.flush()
+        write_atomic(self.path(node_id), "\n".join(digests).encode())
+
+    def read_manifest(self, node_id: str) -> List[str]:
+        with open(self.path(node_id), 'r') as f:
+            return f.read().split()
+
+    def read(self, node_id: str) -> bytes:
+        digests = self.read_manifest(node_id)
+        with self.lock:
+            return b"".join(self.read_chunk(digest) for digest in digests)
+
+    def link(self, src_id: str, dst_id: str):
+        """
+        Linking only copies the manifest, the chunks are shared.
+        """
+        write_atomic(
+            self.path(dst_id), "\n".join(self.read_manifest(src_id)).encode())
+
+    def exists(self, node_id: str) -> bool:
+        return os.path.exists(self.path(node_id))
+
+    def remove(self, node_id: str):
+        if self.exists(node_id):
+            os.remove(self.path(node_id))
+
+    def flush(self):
+        with self.lock:
+            if self.pack_writer is not None:
+                for f in [self.pack_writer, self.index_writer]:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.pack_writer is not None:
+                self.pack_writer.close()
+                self.index_writer.close()
+                self.pack_writer = None
+                self.index_writer = None
+            for reader in self.pack_readers.values():
+                reader.close()
+            self.pack_readers = {}
+
+
+class CachedSnapshotStore(SnapshotStore):
+    """
+    Keeps the live games of recently saved nodes in a bounded LRU cache,
+    in front of another store.
+    The size of a cached game is measured by the size of its snapshot.
+    Saving writes through to the underlying store for durability,
+    but loading a cached node hands over the live game without unpickling,
+    and linking moves the cached game to the destination node.
+
+    The cache owns the games it holds: a caller must not use a game after
+    saving it, and a loaded game is removed from the cache until it is
+    saved again.
+    """
+
+    def __init__(self, store: SnapshotStore, max_size: int):
+        self.store = store
+        self.directory = store.directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, Tuple[Game, int]] = OrderedDict()
+        self.size = 0
+        # snapshot sizes of games handed over by load
+        self.loaned: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def dumps(self, game: Game) -> bytes:
+        return self.store.dumps(game)
+
+    def loads(self, data: bytes) -> Game:
+        return self.store.loads(data)
+
+    def write(self, node_id: str, data: bytes):
+        self.discard(node_id)
+        self.store.write(node_id, data)
+
+    def read(self, node_id: str) -> bytes:
+        return self.store.read(node_id)
+
+    def exists(self, node_id: str) -> bool:
+        return self.store.exists(node_id)
+
+    def put(self, node_id: str, game: Game, size: int):
+        with self.lock:
+            self.pop(node_id)
+            if size > self.max_size:
+                return
+            self.entries[node_id] = (game, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def pop(self, node_id: str):
+        entry = self.entries.pop(node_id, None)
+        if entry is not None:
+            self.size -= entry[1]
+        return entry
+
+    def discard(self, node_id: str):
+        """
+        Drop the cached game of the node, if any.
+        """
+        with self.lock:
+            self.pop(node_id)
+
+    def save(self, node_id: str, game: Game, persist: bool = True):
+        with self.lock:
+            size = self.loaned.pop(node_id, None)
+        if persist or size is None:
+            data = self.store.dumps(game)
+            size = len(data)
+            if persist:
+                self.store.write(node_id, data)
+        self.put(node_id, game, size)
+
+    def load(self, node_id: str) -> Game:
+        with self.lock:
+            entry = self.pop(node_id)
+            if entry is not None:
+                self.hits += 1
+                self.loaned[node_id] = entry[1]
+                return entry[0]
+            self.misses += 1
+        data = self.store.read(node_id)
+        with self.lock:
+            self.loaned[node_id] = len(data)
+        return self.store.loads(data)
+
+    def link(self, src_id: str, dst_id: str):
+        self.store.link(src_id, dst_id)
+        with self.lock:
+            self.pop(dst_id)
+            entry = self.pop(src_id)
+            if entry is not None:
+                self.entries[dst_id] = entry
+                self.size += entry[1]
+
+    def remove(self, node_id: str):
+        with self.lock:
+            self.pop(node_id)
+            self.loaned.pop(node_id, None)
+        self.store.remove(node_id)
+
+    def invalidate(self, node_id: str):
+        self.discard(node_id)
+        self.store.invalidate(node_id)
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+
+class PendingSnapshot:
+    """
+    A snapshot waiting in the queue of a write-behind store.
+    It holds either the game or its serialized data,
+    and is serialized at most once, by the writer or by a reader.
+    """
+
+    def __init__(
+            self,
+            game: Optional[Game] = None,
+            data: Optional[bytes] = None
+    ):
+        self.game = game
+        self.data = data
+        self.lock = threading.Lock()
+
+    def materialize(self, store: SnapshotStore) -> bytes:
+        with self.lock:
+            if self.data is None:
+                self.data = store.dumps(self.game)
+                self.game = None
+            return self.data
+
+
+class WriteBehindSnapshotStore(SnapshotStore):
+    """
+    Moves serialization and file writes of snapshots off the caller's thread.
+    Saved snapshots go into a bounded queue,
+    and a background writer serializes and writes them in batches,
+    with one sync per batch.
+    Reading a pending snapshot serves it straight from the queue.
+    Everything is written by flush, and by close, which also stops
+    the writer until the next save, and runs at interpreter exit.
+
+    The store owns the games it holds: a caller must not use a game after
+    saving it.
+    """
+
+    def __init__(
+            self,
+            store: SnapshotStore,
+            max_pending: int = 64,
+            batch_size: int = 16
+    ):
+        self.store = store
+        self.directory = store.directory
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.pending: Dict[str, PendingSnapshot] = {}
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.writer: Optional[threading.Thread] = None
+        self.start()
+
+    def start(self):
+        """
+        Start the background writer, if it is not running.
+        """
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(
+                    target=self.run,
+                    name="snapshot-writer",
+                    daemon=True
+                )
+                self.writer.start()
+                atexit.register(self.close)
+
+    def dumps(self, game: Game) -> bytes:
+        return self.store.dumps(game)
+
+    def loads(self, data: bytes) -> Game:
+        return self.store.loads(data)
+
+    def enqueue(self, node_id: str, snapshot: PendingSnapshot):
+        self.raise_error()
+        self.start()
+        with self.lock:
+            self.pending[node_id] = snapshot
+        self.queue.put(("write", node_id, snapshot))
+
+    def get_pending(self, node_id: str) -> Optional[PendingSnapshot]:
+        with self.lock:
+            return self.pending.get(node_id)
+
+    def save(self, node_id: str, game: Game, persist: bool = True):
+        if persist:
+            self.enqueue(node_id, PendingSnapshot(game=game))
+
+    def write(self, node_id: str, data: bytes):
+        self.enqueue(node_id, PendingSnapshot(data=data))
+
+    def read(self, node_id: str) -> bytes:
+        snapshot = self.get_pending(node_id)
+        if snapshot is not None:
+            return snapshot.materialize(self.store)
+        return self.store.read(node_id)
+
+    def exists(self, node_id: str) -> bool:
+        return self.get_pending(node_id) is not None \
+            or self.store.exists(node_id)
+
+    def link(self, src_id: str, dst_id: str):
+        snapshot = self.get_pending(src_id)
+        if snapshot is not None:
+            # the destination shares the pending snapshot of the source
+            self.enqueue(dst_id, snapshot)
+        else:
+            if self.get_pending(dst_id) is not None:
+                self.flush()
+            self.store.link(src_id, dst_id)
+
+    def remove(self, node_id: str):
+        with self.lock:
+            self.pending.pop(node_id, None)
+        # removal is queued after any pending write of the node
+        self.start()
+        self.queue.put(("remove", node_id, None))
+
+    def invalidate(self, node_id: str):
+        if self.get_pending(node_id) is not None:
+            self.queue.join()
+            self.raise_error()
+        self.store.invalidate(node_id)
+
+    def run(self):
+        """
+        The loop of the background writer.
+        """
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            written = []
+            try:
+                for op, node_id, snapshot in batch:
+                    if op == "write":
+                        self.store.write(
+                            node_id, snapshot.materialize(self.store))
+                        written.append(node_id)
+                    elif op == "remove":
+                        self.store.remove(node_id)
+                    elif op == "stop":
+                        stop = True
+                self.store.sync(written)
+            except Exception as e:
+                self.error = e
+            for op, node_id, snapshot in batch:
+                with self.lock:
+                    if op == "write" and self.pending.get(node_id) is snapshot:
+                        del self.pending[node_id]
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        self.queue.join()
+        self.raise_error()
+        self.store.flush()
+
+    def close(self):
+        """
+        Write everything and stop the writer.
+        Saves must not run at the same time.
+        """
+        try:
+            self.flush()
+        finally:
+            with self.lock:
+                writer, self.writer = self.writer, None
+            if writer is not None:
+                atexit.unregister(self.close)
+                self.queue.put(("stop", None, None))
+                writer.join()
+            self.store.close()
+
+
+SNAPSHOT_STORES = {
+    "pickle": PickleSnapshotStore,
+    "chunked": ChunkedSnapshotStore,
+}
+
+
+def create_snapshot_store(
+        directory: str,
+        kind: str = "pickle",
+        cache_size: int = 0,
+        write_behind: bool = False,
+        writer: Optional[str] = None,
+        tracer: Optional[Tracer] = None,
+        compression: Optional[str] = None
+) -> SnapshotStore:
+    """
+    Create a snapshot store of the given kind in the directory.
+    If write_behind is True, snapshots are written by a background writer.
+    If cache_size is positive, live games are cached in memory,
+    up to cache_size bytes of snapshots.
+    The cache needs the size of a snapshot when it is saved,
+    so with both enabled, only file writes happen in the background.
+    A writer name is given by every process writing to the same directory
+    besides the sampler itself, stores that need it keep separate files.
+    A tracer records spans of pickling and unpickling the games.
+    Pickle snapshots may be compressed with zlib or lzma,
+    chunked snapshots are compressed chunk by chunk instead,
+    as compressing a whole snapshot would leave no chunks to share.
+    """
+    assert kind in SNAPSHOT_STORES, f"Unknown snapshot store: {kind}"
+    if kind == "chunked":
+        assert compression is None, \
+            "Chunked snapshots are compressed by chunk"
+        store = ChunkedSnapshotStore(directory, writer=writer)
+    else:
+        store = SNAPSHOT_STORES[kind](directory, compression)
+    if tracer is not None:
+        store.tracer = tracer
+    if write_behind:
+        store = WriteBehindSnapshotStore(store)
+    if cache_size > 0:
+        store = CachedSnapshotStore(store, cache_size)
+    return store
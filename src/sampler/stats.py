@@ -0,0 +1,62 @@
+import math
+from typing import Dict
+
+
+def add_metrics(total: Dict[str, float], metrics: Dict[str, float]):
+    """
+    Add metrics to a total, metric by metric.
+    """
+    for k, v in metrics.items():
+        total[k] = total.get(k, 0) + v
+
+
+def new_stats() -> dict:
+    """
+    Running statistics of the results of the rollouts through a node.
+    For every outcome, the mean and the sum of squared deviations (m2)
+    are kept with Welford's algorithm.
+    The statistics are plain dictionaries, so they are archived with the node.
+    """
+    return {"n": 0, "mean": {}, "m2": {}}
+
+
+def update_stats(stats: dict, result: Dict[str, float]):
+    """
+    Add the result of a rollout to the statistics.
+    An outcome missing from a result counts as 0.
+    """
+    stats["n"] += 1
+    n = stats["n"]
+    mean, m2 = stats["mean"], stats["m2"]
+    for k in set(mean) | set(result):
+        # an outcome seen for the first time was 0 in all previous results
+        old_mean = mean.get(k, 0.)
+        x = result.get(k, 0.)
+        delta = x - old_mean
+        mean[k] = old_mean + delta / n
+        m2[k] = m2.get(k, 0.) + delta * (x - mean[k])
+
+
+def variance(stats: dict) -> Dict[str, float]:
+    """
+    Sample variance of each outcome.
+    """
+    n = stats["n"]
+    if n < 2:
+        return {k: math.inf for k in stats["mean"]}
+    return {k: v / (n - 1) for k, v in stats["m2"].items()}
+
+
+def confidence_width(stats: dict, z: float = 1.96) -> float:
+    """
+    Width of the widest confidence interval of the mean of an outcome,
+    by the normal approximation.
+    Infinite if there are fewer than two results.
+    """
+    n = stats["n"]
+    if n < 2:
+        return math.inf
+    return max(
+        (2 * z * math.sqrt(v / n) for v in variance(stats).values()),
+        default=0.
+    )
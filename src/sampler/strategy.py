@@ -0,0 +1,178 @@
+import math
+import random
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
+
+from utils.constants import BRANCHED
+
+if TYPE_CHECKING:
+    from .sampler import GameNode, GameSampler
+
+
+def impurity(result: Dict[str, float]) -> float:
+    """
+    Gini impurity of an aggregated result.
+    The result maps each outcome to the number of times it occurred.
+    Returns 0 if there is no result yet.
+    """
+    total = sum(result.values())
+    if total <= 0:
+        return 0.
+    return 1. - sum((v / total) ** 2 for v in result.values())
+
+
+def branch_gain(node: "GameNode") -> Tuple[float, float]:
+    """
+    How much the outcome of a branched node depends on its branches.
+    The gain is the impurity of the node's result,
+    minus the impurity of its children's results weighted by their visits.
+    Returns the gain and the number of visits of the node.
+    """
+    outcomes = node.outcomes
+    visits = sum(outcomes.values())
+    if visits <= 0:
+        return 0., 0.
+    gain = impurity(outcomes)
+    for child in node.children:
+        child_outcomes = child.outcomes
+        child_visits = sum(child_outcomes.values())
+        gain -= child_visits / visits * impurity(child_outcomes)
+    return max(gain, 0.), visits
+
+
+def level_statistics(sampler: "GameSampler") -> Dict[int, Tuple[int, float]]:
+    """
+    Statistics of the branched nodes with results, by level.
+    The nodes along a trajectory between two branches share the same result,
+    so the level of a node is what tells branching points apart.
+    Returns the number of branched nodes and their mean gain at each level.
+    """
+    stats = {}
+    for node_id in sampler.branch_index[BRANCHED]:
+        node = sampler.nodes[node_id]
+        if any(not child.outcomes for child in node.children):
+            continue
+        gain, visits = branch_gain(node)
+        if visits <= 0:
+            continue
+        count, total = stats.get(node.level, (0, 0.))
+        stats[node.level] = (count + 1, total + gain)
+    return {
+        level: (count, total / count)
+        for level, (count, total) in stats.items()
+    }
+
+
+class SamplingStrategy:
+    """
+    A strategy to select branching points from the candidates of a leaf.
+    The candidates are the upstream branchable nodes of the leaf.
+    """
+    name = None
+
+    def select(
+            self,
+            sampler: "GameSampler",
+            leaf: "GameNode",
+            candidates: List["GameNode"],
+            k: int
+    ) -> List["GameNode"]:
+        """
+        Select k of the candidates to branch.
+        """
+        raise NotImplementedError
+
+
+class UniformStrategy(SamplingStrategy):
+    """
+    Select branching points uniformly at random.
+    """
+    name = "uniform"
+
+    def select(self, sampler, leaf, candidates, k):
+        return random.sample(candidates, k)
+
+
+class LevelBanditStrategy(SamplingStrategy):
+    """
+    Select branching points by the upper confidence bound of their level,
+    a bandit over the levels of the tree rather than UCT over its nodes:
+    a candidate is not branched yet, so it has no gain of its own,
+    and all candidates at a level share the score of the level.
+    The reward of a level is the mean gain of the branched nodes at the level,
+    and its count is the number of those nodes.
+    Levels never branched are tried first.
+    """
+    name = "level_bandit"
+
+    def __init__(self, exploration: float = math.sqrt(2)):
+        self.exploration = exploration
+
+    def select(self, sampler, leaf, candidates, k):
+        stats = level_statistics(sampler)
+        total = sum(count for count, _ in stats.values())
+
+        def score(node: "GameNode") -> float:
+            if node.level not in stats:
+                return math.inf
+            count, gain = stats[node.level]
+            return gain + self.exploration * math.sqrt(math.log(total + 1) / count)
+
+        # ties are broken at random
+        candidates = random.sample(candidates, len(candidates))
+        candidates.sort(key=score, reverse=True)
+        return candidates[:k]
+
+
+class VarianceStrategy(SamplingStrategy):
+    """
+    Select branching points at random,
+    weighted by the estimated outcome variance of branching at their level.
+    The estimate of a level is the mean gain of the branched nodes at the level,
+    smoothed towards the impurity of the root's result.
+    """
+    name = "variance"
+
+    def __init__(self, prior_weight: float = 1., min_weight: float = 1e-3):
+        self.prior_weight = prior_weight
+        self.min_weight = min_weight
+
+    def select(self, sampler, leaf, candidates, k):
+        stats = level_statistics(sampler)
+        prior = impurity(leaf.root.outcomes)
+
+        def weight(node: "GameNode") -> float:
+            count, gain = stats.get(node.level, (0, 0.))
+            estimate = (count * gain + self.prior_weight * prior) \
+                / (count + self.prior_weight)
+            return max(estimate, self.min_weight)
+
+        # weighted sampling without replacement
+        keys = {
+            node.id: random.random() ** (1. / weight(node))
+            for node in candidates
+        }
+        return sorted(candidates, key=lambda x: keys[x.id], reverse=True)[:k]
+
+
+# the name the level bandit was first configured by
+UCTStrategy = LevelBanditStrategy
+
+SAMPLING_STRATEGIES = {
+    strategy.name: strategy
+    for strategy in [UniformStrategy, LevelBanditStrategy, VarianceStrategy]
+}
+SAMPLING_STRATEGIES["uct"] = LevelBanditStrategy
+
+
+def create_sampling_strategy(
+        strategy: Union[str, SamplingStrategy] = "uniform"
+) -> SamplingStrategy:
+    """
+    Create a sampling strategy by name,
+    or return the given strategy as is.
+    """
+    if isinstance(strategy, SamplingStrategy):
+        return strategy
+    assert strategy in SAMPLING_STRATEGIES, \
+        f"unknown sampling strategy: {strategy}"
+    return SAMPLING_STRATEGIES[strategy]()
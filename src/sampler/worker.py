@@ -0,0 +1,86 @@
+import os
+from typing import Optional
+
+from .sampler import GameNode, GameSampler
+
+# the sampler of the worker process, created by init_worker
+sampler: Optional[GameSampler] = None
+
+
+def init_worker(config: dict):
+    """
+    Initialize a rollout worker process.
+    The worker has a sampler of its own over the same directory,
+    which holds only the nodes of the rollout in progress.
+    It writes snapshots under a writer name of its own,
+    and keeps neither a journal nor a config of its own.
+    """
+    global sampler
+    # transpositions are looked up in the tree, which a worker does not hold
+    sampler = GameSampler.from_config(
+        config, transposition=False, writer=f"worker-{os.getpid()}")
+
+
+def roll_out_in_worker(task: dict) -> dict:
+    """
+    Roll out a node of the sample queue in the worker process.
+    The task holds the record of the node and its parent,
+    and the game is loaded from the snapshot of the node.
+    The parent, if any, is rebuilt as a stub,
+    since a concurrent step attaches its nodes to the parent of the node.
+    Returns the records of the nodes of the rollout in the order they
+    were created, the ids of the nodes removed, the id of the leaf,
+    the usage of LLM calls spent, and the trace events of the rollout.
+    """
+    sampler.nodes.clear()
+    sampler.sample_queue.clear()
+    sampler.frontier.clear()
+    for ids in sampler.branch_index.values():
+        ids.clear()
+    usage = dict(sampler.budget.usage)
+
+    parent = None
+    parent_task = task["parent"]
+    if parent_task is not None:
+        parent = GameNode(sampler=sampler, node_id=parent_task["id"])
+        parent.data = parent_task["data"]
+        parent.level = parent_task["level"]
+        parent.depth = parent_task["depth"]
+        parent.branch_status = parent_task["branch_status"]
+
+    node = GameNode(sampler=sampler, parent=parent, node_id=task["id"])
+    node.data = task["data"]
+    node.game_status = task["game_status"]
+    node.branch_status = task["branch_status"]
+    node.settled = task["settled"]
+    # the root of the worker sampler is not sampled
+    sampler.frontier.clear()
+
+    leaf, outcome = node.roll_out()
+    sampler.record_rollout(leaf, outcome)
+    sampler.snapshots.flush()
+
+    stub = {parent.id} if parent is not None else set()
+    records = [
+        sampler.nodes[node_id].record()
+        for node_id in sampler.nodes if node_id not in stub
+    ]
+    removed = [node.id] if node.id not in sampler.nodes else []
+    # the cache only serves within a rollout,
+    # other processes may rewrite these snapshots afterwards
+    for node_id in list(sampler.nodes) + removed:
+        sampler.snapshots.invalidate(node_id)
+    return {
+        "leaf": leaf.id,
+        "records": records,
+        "removed": removed,
+        "parent": {
+            "id": parent.id, "data": parent.data
+        } if parent is not None else None,
+        "usage": {
+            "llm_calls": sampler.budget.llm_calls - usage["llm_calls"],
+            "tokens": sampler.budget.tokens - usage["tokens"],
+        },
+        "trace": sampler.tracer.pop_events(),
+    }
+
@@ -24,3 +24,18 @@ class InvalidToolCall(Exception):
 
 class WrongToolName(Exception):
     ...
+
+
+class ReplayExhausted(Exception):
+    ...
+
+
+class RateLimited(BrainMalfunction):
+    """
+    The provider rejected a call for going over its rate limits.
+    """
+
+    def __init__(self, message: str = "", retry_after: float = None):
+        super().__init__(message)
+        # seconds the provider asks to wait, if it says
+        self.retry_after = retry_after
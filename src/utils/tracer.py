@@ -0,0 +1,168 @@
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+# The lane of the running coroutine, if it was given one.
+# Spans outside of a lane go to the lane of their thread.
+_lane: ContextVar[Optional[int]] = ContextVar("trace_lane", default=None)
+# lanes of coroutines are numbered apart from the ids of threads
+_lane_ids = itertools.count(1 << 32)
+
+
+class Tracer:
+    """
+    Records spans of the work of games and samplers,
+    exported in the Chrome trace event format,
+    which chrome://tracing and Perfetto open.
+    Spans of a thread go to the lane of the thread,
+    and those of a coroutine to the lane given by new_lane, if any,
+    as concurrent coroutines on one thread would not nest.
+    A disabled tracer records nothing.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.pid = os.getpid()
+        self.events: List[dict] = []
+        self.lanes: Dict[int, str] = {}
+        self.lock = threading.Lock()
+
+    def lane(self) -> int:
+        lane = _lane.get()
+        if lane is None:
+            lane = threading.get_native_id()
+            if lane not in self.lanes:
+                self.name_lane(lane, threading.current_thread().name)
+        return lane
+
+    def name_lane(self, lane: int, name: str):
+        with self.lock:
+            self.lanes[lane] = name
+            self.events.append({
+                "name": "thread_name", "ph": "M",
+                "pid": self.pid, "tid": lane, "args": {"name": name},
+            })
+
+    def new_lane(self, name: str):
+        """
+        Give the running coroutine, and the coroutines it awaits,
+        a lane of its own.
+        The lane is set in the context of the task,
+        so call it at the start of a task.
+        """
+        if self.enabled:
+            lane = next(_lane_ids)
+            self.name_lane(lane, name)
+            _lane.set(lane)
+
+    def span(self, name: str, cat: str, **args):
+        """
+        A context manager recording a span of the work in its block.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, cat, args)
+
+    @contextmanager
+    def _span(self, name: str, cat: str, args: dict):
+        lane = self.lane()
+        start = time.time()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = type(e).__name__
+            raise
+        finally:
+            end = time.time()
+            event = {
+                "name": name, "cat": cat, "ph": "X",
+                "ts": start * 1e6, "dur": (end - start) * 1e6,
+                "pid": self.pid, "tid": lane,
+            }
+            if args:
+                event["args"] = args
+            with self.lock:
+                self.events.append(event)
+
+    def instant(self, name: str, cat: str, **args):
+        """
+        Record an event without a duration.
+        """
+        if not self.enabled:
+            return
+        event = {
+            "name": name, "cat": cat, "ph": "i", "s": "t",
+            "ts": time.time() * 1e6,
+            "pid": self.pid, "tid": self.lane(),
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            self.events.append(event)
+
+    def counter(self, name: str, cat: str, value: float):
+        """
+        Record the value of a counter, drawn as a graph over time.
+        """
+        if not self.enabled:
+            return
+        event = {
+            "name": name, "cat": cat, "ph": "C",
+            "ts": time.time() * 1e6,
+            "pid": self.pid, "args": {name: value},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def pop_events(self) -> List[dict]:
+        """
+        Take the events recorded so far, e.g. to send them to another process.
+        """
+        with self.lock:
+            events, self.events = self.events, []
+            # lanes are named again in the events to come
+            self.lanes.clear()
+        return events
+
+    def extend(self, events: List[dict]):
+        """
+        Add the events recorded by another tracer, e.g. of a worker process.
+        """
+        with self.lock:
+            self.events.extend(events)
+
+    def save(self, path: str):
+        """
+        Write the events recorded so far to a trace file.
+        """
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"},
+                      f, ensure_ascii=False)
+
+    def __getstate__(self):
+        return {"enabled": self.enabled}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+_default_tracer = Tracer(enabled=False)
+
+
+def get_default_tracer() -> Tracer:
+    """
+    The tracer of games not attached to a sampler, disabled unless set.
+    """
+    return _default_tracer
+
+
+def set_default_tracer(tracer: Tracer):
+    global _default_tracer
+    _default_tracer = tracer
@@ -1,10 +1,17 @@
+import asyncio
+import codecs
+import hashlib
+import inspect
 import json
 import os
 import pickle
 import random
+import re
 import sys
+import threading
 import uuid
-from typing import List, Dict
+import weakref
+from typing import Any, Awaitable, Dict, Iterator, List, Tuple
 
 from loguru import logger
 
@@ -50,6 +57,46 @@ def unique_identifier():
     return str(uuid.uuid4()).replace("-", "")
 
 
+def stable_hash(obj: Any) -> str:
+    """
+    A hash of a JSON serializable object, stable across processes and runs.
+    """
+    data = json.dumps(obj, ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+
+# the event loop of every thread running coroutines with run_sync
+_thread_loop = threading.local()
+
+
+def run_sync(coro: Awaitable):
+    """
+    Run a coroutine to the end from synchronous code,
+    on a long-lived event loop of the calling thread,
+    so that steps and calls do not set up and tear down a loop each.
+    It must not be called from a coroutine, which should await instead:
+    the loop of the thread would be running already.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        if inspect.iscoroutine(coro):
+            coro.close()
+        raise RuntimeError(
+            "run_sync cannot be called from a running event loop, "
+            "await the coroutine instead")
+    loop = getattr(_thread_loop, "loop", None)
+    # a forked process can not use the loop of its parent
+    if loop is None or loop.is_closed() or _thread_loop.pid != os.getpid():
+        loop = asyncio.new_event_loop()
+        _thread_loop.loop, _thread_loop.pid = loop, os.getpid()
+        # closed once the thread is gone
+        weakref.finalize(threading.current_thread(), loop.close)
+    return loop.run_until_complete(coro)
+
+
 def save_pickle(obj, path):
     with open(path, 'wb') as f:
         pickle.dump(obj, f)
@@ -62,10 +109,85 @@ def read_pickle(path):
 
 
 def save_json(obj, path):
-    with open(path, 'w') as f:
+    with open(path, 'w', encoding='utf-8') as f:
         json.dump(obj, f, ensure_ascii=False)
 
 
 def read_json(path):
-    with open(path, 'r') as f:
+    with open(path, 'r', encoding='utf-8') as f:
         return json.load(f)
+
+
+WHITESPACE = re.compile(r'\s*')
+
+
+def iter_json_object(
+        path: str,
+        chunk_size: int = 1 << 20
+) -> Iterator[Tuple[str, Any, Tuple[int, int]]]:
+    """
+    Iterate over the items of a JSON object saved by save_json,
+    reading the file in chunks instead of loading it as a whole.
+    Yields the key, the value,
+    and the span of the value in the file as (offset, length) in bytes,
+    which read_json_span reads back.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    with open(path, 'rb') as f:
+        buffer = ''
+        offset = 0  # offset of the buffer in bytes
+        eof = False
+        pos = None  # position after the opening brace
+        while True:
+            item = pos
+            try:
+                if pos is None:
+                    pos = WHITESPACE.match(buffer).end()
+                    if buffer[pos] != '{':
+                        raise ValueError(f"{path} is not a JSON object")
+                    pos += 1
+                pos = WHITESPACE.match(buffer, pos).end()
+                if buffer[pos] == '}':
+                    return
+                key, pos = decoder.raw_decode(buffer, pos)
+                pos = WHITESPACE.match(buffer, pos).end()
+                if buffer[pos] != ':':
+                    raise ValueError(f"Expecting ':' in {path}")
+                start = WHITESPACE.match(buffer, pos + 1).end()
+                value, end = decoder.raw_decode(buffer, start)
+                pos = WHITESPACE.match(buffer, end).end()
+                if buffer[pos] not in ',}':
+                    raise ValueError(f"Expecting ',' or '}}' in {path}")
+            except (IndexError, ValueError) as e:
+                # The item is incomplete, read more of the file.
+                if eof:
+                    if isinstance(e, IndexError):
+                        raise ValueError(f"Unexpected end of {path}") from e
+                    raise
+                pos = item
+                data = f.read(max(chunk_size, len(buffer)))
+                eof = not data
+                buffer += utf8.decode(data, final=eof)
+                continue
+
+            span_offset = offset + len(buffer[:start].encode('utf-8'))
+            span_length = len(buffer[start:end].encode('utf-8'))
+            yield key, value, (span_offset, span_length)
+
+            if buffer[pos] == '}':
+                return
+            # Drop the items read from the buffer.
+            offset += len(buffer[:pos + 1].encode('utf-8'))
+            buffer = buffer[pos + 1:]
+            pos = 0
+
+
+def read_json_span(path: str, span: Tuple[int, int]):
+    """
+    Read a JSON value from a span of a file, given as (offset, length) in bytes.
+    """
+    offset, length = span
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return json.loads(f.read(length))
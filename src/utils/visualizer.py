@@ -32,6 +32,7 @@ def create_html_tree(game_name, sampler_id):
 
 def node_to_json(game_node):
     """Convert the game tree node to a format suitable for D3.js visualization"""
+    game_node.load_detail()
     node_data = {
         "id": game_node.id,
         "display": {},